@@ -1,29 +1,40 @@
+from codex import helper, timing
+from codex.batch import quantify_batch
 from codex.experiment import Codex
 from codex.helper import (
     CHANNEL_NUM,
     IMG_FULL,
     NUM_CHANNEL,
     RESOLUTION,
-    TMA,
+    configure,
     crop_tma,
     load_tma,
 )
+from codex.index import scan_cohort
 from codex.interactive import (
     interactive_labeled_slide,
     interactive_labeled_tile,
     interactive_slide,
     interactive_tile,
+    serve_slide_viewer,
+    show_slide_viewer,
+    slide_viewer,
 )
 from codex.plot import plot_labeled_slide, plot_tile_location, plot_tiles_on_slide
+from codex.preprocess import Pipeline
 from codex.quantify import quantify_segmentation
-from codex.util import clahe, load_all_tma, load_raw_tma
+from codex.spatial import CellIndex
+from codex.store import QuantificationStore
+from codex.util import clahe, iter_tma, load_all_tma, load_raw_tma
 
 __all__ = [
     "Codex",
+    "configure",
     "crop_tma",
     "clahe",
     "load_tma",
     "load_all_tma",
+    "iter_tma",
     "load_raw_tma",
     "show_slide",
     "show_tile",
@@ -35,10 +46,26 @@ __all__ = [
     "interactive_labeled_tile",
     "interactive_labeled_slide",
     "interactive_slide",
+    "slide_viewer",
+    "show_slide_viewer",
+    "serve_slide_viewer",
     "quantify_segmentation",
+    "quantify_batch",
+    "scan_cohort",
+    "QuantificationStore",
+    "CellIndex",
+    "Pipeline",
+    "timing",
     "CHANNEL_NUM",
     "NUM_CHANNEL",
     "IMG_FULL",
     "TMA",
     "RESOLUTION",
 ]
+
+
+def __getattr__(name):
+    # the TMA table is only parsed on first access
+    if name == "TMA":
+        return helper.TMA
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,187 @@
+import argparse
+import os
+import sys
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Tuple, Union
+
+import pandas as pd
+from tqdm import tqdm
+
+from codex.experiment import Codex
+from codex.helper import IMG_FULL, core_name, crop_tma, get_tma, read_tma
+from codex.quantify import quantify_segmentation
+from codex.store import QuantificationStore
+
+# cores (Codex objects or TMA rows) shared with the workers
+_SOURCES = {}
+
+
+def _load_core(row: dict, tma_path: str, offset: Union[int, None] = None) -> Codex:
+    """
+    Loads a single core of the TMA table (run inside the worker).
+    """
+    img = crop_tma(
+        read_tma(IMG_FULL[row["TMA"]]),
+        row["Row"],
+        row["Col"],
+        nrows=row["Nrows"],
+        ncols=row["Ncols"],
+    )
+    seg_path = os.path.join(tma_path, f"{core_name(row)}_128")
+    return Codex(seg_path, img, offset=offset)
+
+
+def _init_worker(sources: dict):
+    global _SOURCES
+    _SOURCES = sources
+
+
+def _quantify_unit(name, tma_path, offset, x, y, kwargs) -> pd.DataFrame:
+    """
+    Quantifies one core (or one tile of it if x and y are given).
+    """
+    source = _SOURCES[name]
+    if isinstance(source, Codex):
+        experiment = source
+    else:
+        experiment = _load_core(source, tma_path, offset)
+
+    return quantify_segmentation(experiment, x, y, progress=False, **kwargs)
+
+
+def _sources(cores) -> OrderedDict:
+    if isinstance(cores, pd.DataFrame):
+        return OrderedDict((core_name(row), row) for row in cores.to_dict("records"))
+    return OrderedDict(cores)
+
+
+def _units(sources: dict, tiles: bool):
+    """
+    Yields (key, name, x, y) for every core or tile in input order.
+    """
+    for name, source in sources.items():
+        if not tiles:
+            yield name, name, None, None
+            continue
+
+        if not isinstance(source, Codex):
+            raise ValueError("Tile-level batches require Codex objects.")
+
+        for x, y in source[None].keys():
+            yield (name, x, y), name, x, y
+
+
+def quantify_batch(
+    cores: Union[pd.DataFrame, Dict[str, Codex]] = None,
+    tma_path: Union[None, str] = None,
+    workers: Union[None, int] = None,
+    tiles: bool = False,
+    offset: Union[None, int] = None,
+    store: Union[None, str, QuantificationStore] = None,
+    **kwargs,
+) -> Tuple[Dict, Dict]:
+    """
+    Runs quantify_segmentation for every core of a TMA table (or of the
+    dict of Codex objects returned by load_all_tma) on a process pool.
+
+    Returns the results in input order and the tracebacks of the cores
+    (or tiles) that failed; a failure does not affect the other units.
+    The cores are handed to the workers once at start-up (for free with the
+    fork start method) rather than with every task.
+
+    With a store (QuantificationStore or its folder) every finished unit is
+    written as soon as it completes and units already in the store are skipped,
+    so an interrupted run resumes where it stopped. The results are then not
+    kept in memory (read them with store.read).
+
+    With tiles=True every tile is quantified on its own: ids and x/y are those
+    of the tile, the results are keyed by (core, x, y) and store.read adds the
+    tile_x and tile_y columns.
+    """
+    if cores is None:
+        cores = get_tma()
+    if isinstance(cores, pd.DataFrame) and tma_path is None:
+        raise ValueError("tma_path is required to load cores from a TMA table.")
+
+    if isinstance(store, str):
+        store = QuantificationStore(store)
+
+    sources = _sources(cores)
+    units = list(_units(sources, tiles))
+    if store is not None:
+        units = [unit for unit in units if unit[0] not in store]
+    results, failed = {}, {}
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(sources,)
+    ) as pool:
+        futures = {
+            pool.submit(_quantify_unit, name, tma_path, offset, x, y, kwargs): key
+            for key, name, x, y in units
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            key = futures[future]
+            try:
+                if store is None:
+                    results[key] = future.result()
+                else:
+                    store.write(key, future.result())
+            except Exception as e:
+                failed[key] = "".join(
+                    traceback.format_exception(type(e), e, e.__traceback__)
+                )
+
+    keys = [key for key, *_ in units]
+    return (
+        OrderedDict((key, results[key]) for key in keys if key in results),
+        OrderedDict((key, failed[key]) for key in keys if key in failed),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Quantifies the segmentation of TMA cores in parallel."
+    )
+    parser.add_argument("tma_path", help="folder with the <core>_128 tile folders")
+    parser.add_argument(
+        "output", help="folder the results are stored in (resumed if it exists)"
+    )
+    parser.add_argument("--names", nargs="*", help="only quantify these cores")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--offset", type=int, default=None)
+    parser.add_argument("--segmentation", default="lgbm_test_sub2")
+    parser.add_argument("--channels", action="store_true")
+    parser.add_argument(
+        "--csv", action="store_true", help="write <core>.csv tables instead"
+    )
+    args = parser.parse_args(argv)
+
+    tma = get_tma()
+    if args.names:
+        tma = tma[tma.apply(core_name, 1).isin(args.names)]
+
+    results, failed = quantify_batch(
+        tma,
+        args.tma_path,
+        workers=args.workers,
+        offset=args.offset,
+        segmentation=args.segmentation,
+        channels=args.channels,
+        store=None if args.csv else args.output,
+    )
+
+    if args.csv:
+        os.makedirs(args.output, exist_ok=True)
+        for name, df in results.items():
+            df.to_csv(os.path.join(args.output, f"{name}.csv"))
+
+    for name, error in failed.items():
+        print(f"Failed to quantify {name}:\n{error}", file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
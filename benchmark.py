@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, List, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+from skimage.draw import disk
+
+from codex import helper
+from codex.experiment import Codex
+from codex.helper import DEFAULT_CHANNEL, DEFAULT_SEGMENTATION
+from codex.quantify import quantify_segmentation
+from codex.segmentation import label_segmentation_mask
+
+SIZES = [(1024, 1024), (1100, 1030), (2048, 2048)]
+DENSITIES = [2e-4, 1e-3]  # cells per pixel
+CHANNELS = [DEFAULT_CHANNEL, "CD3", "CD20", "Ki67"]
+
+
+def make_core(
+    root: str,
+    name: str = "core",
+    height: int = 1024,
+    width: int = 1024,
+    density: float = 2e-4,
+    channels: int = len(CHANNELS),
+    tile_size: int = 128,
+    seed: int = 0,
+) -> Tuple[str, np.ndarray]:
+    """
+    Writes a synthetic core in the layout Segmentation expects: the tiles of the
+    first channel to <root>/<name>_128 and label tiles (numbered per tile like
+    the network output) to <root>/<name>_128_segmented/<segmentation>.
+    Returns the tile folder and the (channels, 2, height, width) image.
+    """
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 500, size=(channels, 2, height, width), dtype=np.uint16)
+    labels = np.zeros((height, width), dtype=np.int32)
+    for i in range(1, int(density * height * width) + 1):
+        center = rng.integers(8, height - 8), rng.integers(8, width - 8)
+        rows, cols = disk(center, rng.integers(3, 8), shape=labels.shape)
+        labels[rows, cols] = i
+        img[:, :, rows, cols] += rng.integers(
+            500, 3000, size=(channels, 2, 1), dtype=np.uint16
+        )
+
+    path = os.path.join(root, f"{name}_128")
+    seg_path = os.path.join(root, f"{name}_128_segmented", DEFAULT_SEGMENTATION)
+    os.makedirs(path, exist_ok=True)
+    os.makedirs(seg_path, exist_ok=True)
+
+    x_ticks = np.linspace(0, width, width // tile_size + 1).astype(int)
+    y_ticks = np.linspace(0, height, height // tile_size + 1).astype(int)
+    for x in range(len(x_ticks) - 1):
+        for y in range(len(y_ticks) - 1):
+            rows = slice(y_ticks[y], y_ticks[y + 1])
+            cols = slice(x_ticks[x], x_ticks[x + 1])
+            window = rows, cols
+            tile = (img[0, 0][window] // 16).clip(0, 255).astype(np.uint8)
+            cv2.imwrite(os.path.join(path, f"{name}_{x}_{y}.png"), tile)
+
+            _, tile_labels = np.unique(labels[window], return_inverse=True)
+            tile_labels = tile_labels.reshape(tile.shape).astype(np.uint16)
+            cv2.imwrite(os.path.join(seg_path, f"{name}_{x}_{y}.tif"), tile_labels)
+
+    return path, img
+
+
+def configure_channels(folder: str, channels: List[str] = CHANNELS):
+    """
+    Points helper at a channel table with the synthetic channels.
+    """
+    with open(os.path.join(folder, "channelnames_ch2.txt"), "w") as f:
+        f.write("\n".join(channels) + "\n")
+    helper.configure(codex_folder=folder)
+
+
+def measure(func: Callable, repeat: int = 3) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmarks(path: str, img: np.ndarray) -> dict:
+    """
+    Returns the timed operations on a synthetic core. Every run starts from a
+    fresh Codex object so that no in-memory cache carries over.
+    """
+
+    def fresh():
+        return Codex(path, img, persist=False)
+
+    def restored():
+        experiment = fresh()
+        experiment.get_slide(DEFAULT_SEGMENTATION)
+        return experiment
+
+    experiment = restored()
+    segmentation = experiment.get_slide(DEFAULT_SEGMENTATION)
+    ids = np.unique(segmentation)
+    annotation = pd.DataFrame({"id": ids[ids > 0], "type": ids[ids > 0] % 5})
+    height, width = segmentation.shape
+    window = (width // 4, width // 4 + 512), (height // 4, height // 4 + 512)
+
+    return {
+        "codex": fresh,
+        "get_slide": lambda: fresh().get_slide(DEFAULT_SEGMENTATION),
+        "get_border_cells": lambda: restored().get_border_cells(),
+        "quantify": lambda: quantify_segmentation(experiment, progress=False),
+        "quantify_channels": lambda: quantify_segmentation(
+            experiment, channels=True, progress=False
+        ),
+        "quantify_moments": lambda: quantify_segmentation(
+            experiment, engine="moments", progress=False
+        ),
+        "label_segmentation_mask": lambda: label_segmentation_mask(
+            segmentation, annotation
+        ),
+        "slide_overlay": lambda: experiment.get_slide_overlay(*window),
+        "viewer_levels": lambda: viewer_levels(experiment),
+    }
+
+
+def viewer_levels(experiment: Codex, segmentation: str = DEFAULT_SEGMENTATION):
+    """
+    Renders the whole slide with its segmentation at every pyramid level like
+    the slide viewer (this also checks that the levels of both pyramids match).
+    """
+    from codex.interactive import _render_window
+
+    height, width = experiment.get_slide(DEFAULT_CHANNEL).shape
+    rows, cols = slice(0, height), slice(0, width)
+    for level in range(len(experiment.get_pyramid(DEFAULT_CHANNEL))):
+        size = height // 2**level, width // 2**level
+        _render_window(experiment, DEFAULT_CHANNEL, segmentation, rows, cols, *size)
+
+
+def run(
+    sizes: List[Tuple[int, int]] = SIZES,
+    densities: List[float] = DENSITIES,
+    repeat: int = 3,
+    only: List[str] = None,
+) -> List[dict]:
+    """
+    Times every benchmark on synthetic cores of the given sizes and cell
+    densities. Returns one record per benchmark and core.
+    """
+    previous = helper.CODEX_FOLDER
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        configure_channels(root)
+        try:
+            for height, width in sizes:
+                for density in densities:
+                    name = f"core{height}x{width}d{density:g}"
+                    path, img = make_core(root, name, height, width, density)
+                    for benchmark, func in benchmarks(path, img).items():
+                        if only and benchmark not in only:
+                            continue
+                        times = measure(func, repeat)
+                        results.append(
+                            {
+                                "benchmark": benchmark,
+                                "height": height,
+                                "width": width,
+                                "density": density,
+                                "best": min(times),
+                                "mean": float(np.mean(times)),
+                            }
+                        )
+                        print(f"{name} {benchmark}: {min(times):.4f}s", file=sys.stderr)
+        finally:
+            helper.configure(codex_folder=previous)
+
+    return results
+
+
+def save(results: List[dict], path: str, label: str = ""):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "label": label,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def load(path: str) -> pd.DataFrame:
+    with open(path) as f:
+        return pd.DataFrame(json.load(f)["results"])
+
+
+def compare(old: str, new: str) -> pd.DataFrame:
+    """
+    Joins two stored runs on benchmark and core, speedup > 1 means new is faster.
+    """
+    keys = ["benchmark", "height", "width", "density"]
+    df = load(old)[keys + ["best"]].merge(
+        load(new)[keys + ["best"]], on=keys, suffixes=("_old", "_new")
+    )
+    return df.assign(speedup=df["best_old"] / df["best_new"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks codex on synthetic cores.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("output", help="json file the timings are written to")
+    run_parser.add_argument(
+        "--sizes", nargs="*", default=[f"{h}x{w}" for h, w in SIZES]
+    )
+    run_parser.add_argument("--densities", nargs="*", type=float, default=DENSITIES)
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--only", nargs="*", help="only run these benchmarks")
+    run_parser.add_argument("--label", default="", help="e.g. the git revision")
+
+    compare_parser = sub.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        sizes = [tuple(int(n) for n in size.split("x")) for size in args.sizes]
+        results = run(sizes, args.densities, args.repeat, args.only)
+        save(results, args.output, label=args.label)
+    else:
+        print(compare(args.old, args.new).to_string(index=False))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Iterable, Union
+
+import numpy as np
+
+MB = 1024**2
+
+
+def nbytes_of(value) -> int:
+    """
+    Memory held by a cached value. Memory-mapped arrays are paged in and out by
+    the OS and do not count.
+    """
+    if isinstance(value, np.memmap):
+        return 0
+    return getattr(value, "nbytes", 0)
+
+
+def layer_of(key):
+    """
+    Tiles are cached under (layer, x, y), slides under their layer name.
+    """
+    return key[0] if isinstance(key, tuple) else key
+
+
+class LRUCache(MutableMapping):
+    """
+    Dict-like cache bounded by the total nbytes of its values. When the budget is
+    exceeded the least recently used entries are evicted, except for entries of
+    pinned layers and the entry just stored (so a value larger than the budget
+    is still kept until the next one). max_bytes=None disables eviction.
+    """
+
+    def __init__(self, max_bytes: Union[None, int] = None, pinned: Iterable = ()):
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= nbytes_of(self._data.pop(key))
+
+            self._data[key] = value
+            self.nbytes += nbytes_of(value)
+            self._evict(keep=key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.nbytes -= nbytes_of(self._data.pop(key))
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None or self.nbytes <= self.max_bytes:
+            return
+
+        for key in list(self._data):
+            if self.nbytes <= self.max_bytes:
+                break
+            if layer_of(key) in self.pinned or key == keep:
+                continue
+
+            del self[key]
+            self.evictions += 1
+
+    def pin(self, layer):
+        self.pinned.add(layer)
+
+    def unpin(self, layer):
+        self.pinned.discard(layer)
+        with self._lock:
+            self._evict()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def fingerprint(files: Iterable[str]) -> list:
+    """
+    Identifies a set of files by their names, sizes and modification times.
+    """
+    stats = [(f, os.stat(f)) for f in files]
+    return [[os.path.basename(f), s.st_size, s.st_mtime_ns] for f, s in stats]
+
+
+def save_array(path: str, arr: np.ndarray, meta: dict):
+    """
+    Stores arr as <path>.npy together with meta in <path>.json. Both files are
+    written to temporary files first so readers never see partial data.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f".{os.getpid()}.tmp"
+    stored = np.lib.format.open_memmap(
+        path + ".npy" + tmp, mode="w+", dtype=arr.dtype, shape=arr.shape
+    )
+    stored[:] = arr
+    stored.flush()
+    del stored
+    os.replace(path + ".npy" + tmp, path + ".npy")
+
+    with open(path + ".json" + tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".json" + tmp, path + ".json")
+
+
+def load_array(path: str, fingerprint: list):
+    """
+    Memory-maps an array stored with save_array. Returns the array and its meta
+    data, or None if there is none or it was stored for a different fingerprint.
+    """
+    try:
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if meta.get("fingerprint") != fingerprint:
+            return None
+        return np.load(path + ".npy", mmap_mode="r"), meta
+    except (OSError, ValueError):
+        return None
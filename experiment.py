@@ -1,93 +1,133 @@
+import hashlib
 import os
-from collections import OrderedDict, defaultdict
-from glob import glob
-from typing import Callable, Union
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Tuple, Union
 
 import cv2
 import numpy as np
 from skimage.color import rgba2rgb
 from stardist.plot import render_label
 
-from codex.helper import CHANNEL_NUM, DEFAULT_CHANNEL, DEFAULT_SEGMENTATION
+from codex.cache import MB, LRUCache, fingerprint, load_array, save_array
+from codex.helper import (
+    CHANNEL_NUM,
+    DEFAULT_CHANNEL,
+    DEFAULT_SEGMENTATION,
+    get_window,
+    intensity_range,
+    normalize_range,
+    thumbnail,
+)
+from codex.index import cache_dir, get_x_and_y, index_folder  # noqa: F401
+from codex.pyramid import build_pyramid, load_pyramid, save_pyramid
+from codex.stitch import stitch_labels
+from codex.timing import span, timed
 
 
-def get_x_and_y(name):
-    x, y = os.path.splitext(name)[0].split("_")[-2:]
-    return int(x), int(y)
+def identity(img):
+    return img
 
 
 class Segmentation:
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: str,
+        workers: Union[None, int] = None,
+        index: Union[None, dict] = None,
+        slide_cache_bytes: Union[None, int] = 2048 * MB,
+        pin: tuple = (),
+        stitch: bool = False,
+        min_overlap: int = 1,
+    ):
         self.path = os.path.normpath(path)
+        self.workers = workers
+        self.stitch = stitch
+        self.min_overlap = min_overlap
         self.index = {}
-        self._index_files()
-
-        self.slides = {}
+        if index is None:
+            self._index_files()
+        else:
+            self.index = index
+
+        self.slides = LRUCache(slide_cache_bytes, pinned=pin)
+        # (x_ticks, y_ticks) of the tile grid of every restored slide
+        self.grids = {}
+        # number of downsampled levels of every layer
+        self.pyramid_levels = {}
+        # ids of the cells that were stitched across tile edges
+        self.merged = {}
 
     def __getitem__(self, item: str):
         return self.index[item]
 
+    @timed("index_files")
     def _index_files(self):
         """
-        Indexes the files in folders generated by the neural network.
+        Indexes the files in folders generated by the neural network (cached in
+        a manifest that is rebuilt when the folders change).
         """
-        # get source images
-        source_files = glob(os.path.join(self.path, "**/*.png"), recursive=True)
-
-        self.index[None] = {
-            get_x_and_y(f): f
-            for f in sorted(source_files, key=lambda x: get_x_and_y(x)[::-1])
-        }
-
-        segmented_path = os.path.join(
-            os.path.dirname(self.path), os.path.basename(self.path) + "_segmented"
-        )
-
-        sub_dir = [
-            p
-            for p in os.listdir(segmented_path)
-            if os.path.isdir(os.path.join(segmented_path, p))
-        ]
-
-        for p in sub_dir:
-            sub_index = OrderedDict()
-            for f in sorted(
-                os.listdir(os.path.join(segmented_path, p)),
-                key=lambda x: get_x_and_y(x)[::-1],
-            ):
-                sub_index[get_x_and_y(f)] = os.path.join(segmented_path, p, f)
-            self.index[p] = sub_index
+        self.index = index_folder(self.path)
 
-    def _restore(self, name: Union[None, str] = None):
+    @timed("restore")
+    def _restore(self, name: Union[None, str] = None, workers: Union[None, int] = None):
         """
-        Restores tiles to a full slide.
+        Restores tiles to a full slide. The slide is allocated once and every tile
+        is decoded straight into its slot (on a thread pool if workers is given).
+        With stitch=True labels cut by tile edges are merged (see stitch_labels).
         """
-        x_max, y_max = np.array(list(self[name].keys())).max(axis=0)
-
-        tiles = {}
-        max_number = 0
-
-        for (x, y), path in self[name].items():
-            tile = cv2.imread(path, -1)
-            if os.path.splitext(path)[1] == ".tif":
-                # print(x, y, max_number, tile.max())
-                tile = tile.astype(np.int32)
-                adjusted_tile = (tile + max_number) * (tile > 0)
-                if adjusted_tile.max() > 0:
-                    max_number = adjusted_tile.max()
-
-                tiles[(x, y)] = adjusted_tile.copy()
-            else:
-                tiles[(x, y)] = tile
-
-        long_tiles = []
-        for y in range(y_max + 1):
-            long_tiles.append([])
-            for x in range(x_max + 1):
-                long_tiles[-1].append(tiles[(x, y)])
+        index = self[name]
+        workers = self.workers if workers is None else workers
+        x_max, y_max = np.array(list(index.keys())).max(axis=0)
+
+        # the first row and column of tiles define the grid
+        decoded = {(x, 0): cv2.imread(index[(x, 0)], -1) for x in range(x_max + 1)}
+        for y in range(1, y_max + 1):
+            decoded[(0, y)] = cv2.imread(index[(0, y)], -1)
+
+        x_ticks = np.cumsum([0] + [decoded[(x, 0)].shape[1] for x in range(x_max + 1)])
+        y_ticks = np.cumsum([0] + [decoded[(0, y)].shape[0] for y in range(y_max + 1)])
+
+        first = decoded[(0, 0)]
+        labels = os.path.splitext(index[(0, 0)])[1] == ".tif"
+        slide = np.zeros(
+            (y_ticks[-1], x_ticks[-1]) + first.shape[2:],
+            dtype=np.int32 if labels else first.dtype,
+        )
 
-        long_tiles = [np.hstack(i) for i in long_tiles]
-        return np.vstack(long_tiles)
+        def place(key):
+            x, y = key
+            tile = decoded.pop(key, None)
+            if tile is None:
+                tile = cv2.imread(index[key], -1)
+
+            slide[y_ticks[y] : y_ticks[y + 1], x_ticks[x] : x_ticks[x + 1]] = tile
+            return int(tile.max()) if labels else 0
+
+        # tiles are ordered row by row
+        keys = list(index.keys())
+        if workers:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                maxima = list(pool.map(place, keys))
+        else:
+            maxima = [place(key) for key in keys]
+
+        if labels:
+            # shift the labels of each tile by the labels of all previous tiles
+            for (x, y), offset in zip(keys, np.cumsum([0] + maxima[:-1])):
+                if offset == 0:
+                    continue
+                slot = slide[y_ticks[y] : y_ticks[y + 1], x_ticks[x] : x_ticks[x + 1]]
+                slot[slot > 0] += offset
+
+            if self.stitch:
+                with span("stitch", layer=name):
+                    slide, self.merged[name] = stitch_labels(
+                        slide, x_ticks, y_ticks, min_overlap=self.min_overlap
+                    )
+
+        self.grids[name] = (x_ticks, y_ticks)
+        return slide
 
     def keys(self):
         return self.index.keys()
@@ -134,8 +174,10 @@ class Slide:
         img,
         x_tile_size: int = 128,
         y_tile_size: int = 128,
-        preprocess_tile: Callable = lambda x: x,
+        preprocess_tile: Callable = identity,
         offset: Union[int, None] = None,
+        cache_bytes: Union[None, int] = 512 * MB,
+        pin: tuple = (),
     ):
         self.img = img
         self.x_tile_size = x_tile_size
@@ -143,41 +185,72 @@ class Slide:
         self.preprocess_tile = preprocess_tile
         self.offset = offset
 
-        self.tiles = defaultdict(dict)
+        # tiles of all layers keyed by (name, x, y)
+        self.tiles = LRUCache(cache_bytes, pinned=pin)
+
+        # only the tile grid is computed here, tiles are split off on demand
+        height, width = self.img.shape[-2:]
+        if self.offset is not None:
+            height, width = height - self.offset, width - self.offset
 
-        for channel in CHANNEL_NUM.keys():
-            self._split(channel)
+        x_tiles_cnt = width // self.x_tile_size
+        y_tiles_cnt = height // self.y_tile_size
+        self.x_ticks = np.linspace(0, width, x_tiles_cnt + 1).astype(int)
+        self.y_ticks = np.linspace(0, height, y_tiles_cnt + 1).astype(int)
 
     def __getitem__(self, item):
         raise NotImplementedError
 
-    def _split(self, name: Union[None, str] = None):
+    def _channel(self, name: str) -> np.ndarray:
         """
-        Splits the raw image into tiles. The oppposite of '_restore'.
+        Returns the raw image of a channel (after applying the offset).
         """
         img = self.img[CHANNEL_NUM[name], 0 if name == DEFAULT_CHANNEL else 1]
 
         if self.offset is not None:
             img = img[self.offset :, self.offset :]
 
-        # if (x_tile_size is not None) and (y_tile_size is not None):
-        x_tiles_cnt = img.shape[1] // self.x_tile_size
-        y_tiles_cnt = img.shape[0] // self.y_tile_size
-        # if (x_tiles_cnt is not None) and (y_tiles_cnt is not None):
-        x_ticks = np.linspace(0, img.shape[1], x_tiles_cnt + 1).astype(int)
-        y_ticks = np.linspace(0, img.shape[0], y_tiles_cnt + 1).astype(int)
+        return img
+
+    def _tile_key(self, name: Union[None, str], x: int, y: int) -> tuple:
+        """
+        Cache key of a tile. Channel tiles preprocessed by a Pipeline are also
+        keyed by its hash.
+        """
+        key = getattr(self.preprocess_tile, "key", None)
+        if key is None or name not in CHANNEL_NUM.keys():
+            return (name, x, y)
+        return (name, x, y, key)
 
-        tiles = []
-        tile_names = []
+    def _split_tile(self, x: int, y: int, name: str) -> np.ndarray:
+        """
+        Splits a single tile off the raw image and preprocesses it on first
+        access.
+        """
+        im = self.tiles.get(self._tile_key(name, x, y))
+        if im is not None:
+            return im
 
-        for x_num, x in enumerate(zip(x_ticks[:-1], x_ticks[1:])):
-            for y_num, y in enumerate(zip(y_ticks[:-1], y_ticks[1:])):
-                im = img[y[0] : y[1], x[0] : x[1]]
-                im = self.preprocess_tile(im)
-                tiles.append(im)
-                tile_names.append((x_num, y_num))
+        if not (0 <= x < len(self.x_ticks) - 1 and 0 <= y < len(self.y_ticks) - 1):
+            raise KeyError((x, y))
 
-        self.tiles[name] = dict(zip(tile_names, tiles))
+        with span("split_tile", layer=name):
+            im = self._channel(name)[
+                self.y_ticks[y] : self.y_ticks[y + 1],
+                self.x_ticks[x] : self.x_ticks[x + 1],
+            ]
+            im = self.preprocess_tile(im)
+        self.tiles[self._tile_key(name, x, y)] = im
+
+        return im
+
+    def _split(self, name: Union[None, str] = None):
+        """
+        Splits the raw image into tiles. The oppposite of '_restore'.
+        """
+        for x in range(len(self.x_ticks) - 1):
+            for y in range(len(self.y_ticks) - 1):
+                self._split_tile(x, y, name)
 
     # def get_tile(self, x: int, y: int, name: Union[None, str] = None):
     #     """
@@ -192,34 +265,230 @@ class Slide:
 
 
 class Codex(Segmentation, Slide):
-    def __init__(self, path, img, x_tile_size=128, y_tile_size=128, offset=None):
-        Segmentation.__init__(self, path)
+    def __init__(
+        self,
+        path,
+        img,
+        x_tile_size=128,
+        y_tile_size=128,
+        offset=None,
+        workers=None,
+        index=None,
+        cache_bytes=512 * MB,
+        slide_cache_bytes=2048 * MB,
+        pin=(),
+        persist=False,
+        stitch=False,
+        min_overlap=1,
+        prefetch=False,
+        preprocess_tile=identity,
+    ):
+        """
+        Tiles and restored slides are kept in LRU caches bounded by cache_bytes
+        and slide_cache_bytes (None for no limit); layers in pin are never evicted.
+        With persist=True restored slides and pyramids are written to disk, to the
+        cache folder <path>_cache next to the tiles, and memory-mapped by later
+        sessions. With stitch=True
+        cells cut by tile edges (touching along at least min_overlap pixels) are
+        merged when a segmentation is restored. With prefetch=True every get_tile
+        call reads the neighbouring tiles and the same tile of the other layers
+        in the background. Channel tiles are passed through preprocess_tile (e.g. a
+        preprocess.Pipeline) when they are split off.
+        """
+        Segmentation.__init__(
+            self,
+            path,
+            workers=workers,
+            index=index,
+            slide_cache_bytes=slide_cache_bytes,
+            pin=pin,
+            stitch=stitch,
+            min_overlap=min_overlap,
+        )
         Slide.__init__(
-            self, img, x_tile_size=x_tile_size, y_tile_size=y_tile_size, offset=offset
+            self,
+            img,
+            x_tile_size=x_tile_size,
+            y_tile_size=y_tile_size,
+            preprocess_tile=preprocess_tile,
+            offset=offset,
+            cache_bytes=cache_bytes,
+            pin=pin,
         )
+        self.persist = persist
+        self.prefetch = prefetch
+        # (low, high) intensity percentiles of every slide
+        self.intensity_ranges = {}
+        self._init_reader()
+
+    def _init_reader(self):
+        # the reader pool is started on first use, tiles being read are pending
+        self._pool = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["_pool", "_pending", "_lock", "_pid"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_reader()
+
+    def close(self):
+        """
+        Stops the tile reader threads.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _load_tile(self, key: tuple) -> np.ndarray:
+        name, x, y = key
+        try:
+            if name in CHANNEL_NUM.keys():
+                return self._split_tile(x, y, name)
+
+            img = cv2.imread(self[name][(x, y)], -1)
+            self.tiles[key] = img
+            return img
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _fetch(self, key: tuple) -> Future:
+        """
+        Returns the future of a tile read on the reader pool.
+        """
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if self._pool is None or self._pid != os.getpid():
+                    # threads do not survive a fork, start a new pool
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers or 8)
+                    self._pid = os.getpid()
+                future = self._pool.submit(self._load_tile, key)
+                self._pending[key] = future
+        return future
+
+    def _has_tile(self, key: tuple) -> bool:
+        name, x, y = key
+        if name in CHANNEL_NUM.keys():
+            return 0 <= x < len(self.x_ticks) - 1 and 0 <= y < len(self.y_ticks) - 1
+        return (x, y) in self[name]
+
+    def _prefetch(self, x: int, y: int, name: Union[None, str]):
+        neighbours = [
+            (name, x + i, y + j) for i in (-1, 0, 1) for j in (-1, 0, 1) if i or j
+        ]
+        layers = [(layer, x, y) for layer in self.keys() if layer != name]
+        for key in neighbours + layers:
+            if self._tile_key(*key) not in self.tiles and self._has_tile(key):
+                self._fetch(key)
 
     def get_tile(self, x, y, name=DEFAULT_CHANNEL):
-        if name in self.tiles.keys() and (x, y) in self.tiles[name]:
-            return self.tiles[name][(x, y)]
+        img = self.tiles.get(self._tile_key(name, x, y))
+        if img is None:
+            future = self._pending.get((name, x, y))
+            if future is not None and self._pid == os.getpid():
+                img = future.result()
+            else:
+                img = self._load_tile((name, x, y))
 
-        img = cv2.imread(self[name][(x, y)], -1)
-        self.tiles[name][(x, y)] = img
+        if self.prefetch:
+            self._prefetch(x, y, name)
 
         return img
 
-    def get_slide(self, name: Union[None, str] = DEFAULT_CHANNEL):
+    def get_tiles(
+        self, coords: List[Tuple[int, int]], name: Union[None, str] = DEFAULT_CHANNEL
+    ) -> List[np.ndarray]:
+        """
+        Returns the tiles at coords [(x, y), ...] of a layer, the tiles that are
+        not cached are read concurrently.
+        """
+        keys = [(name, x, y) for x, y in coords]
+        tiles = [self.tiles.get(self._tile_key(*key)) for key in keys]
+        futures = [
+            self._fetch(key) if tile is None else None for key, tile in zip(keys, tiles)
+        ]
+        return [
+            tile if future is None else future.result()
+            for tile, future in zip(tiles, futures)
+        ]
+
+    def get_slide(self, name: Union[None, str] = DEFAULT_CHANNEL, level: int = 0):
         """
-        Returns the full slide and caches them.
+        Returns the full slide and caches them. Levels > 0 return the slide
+        downsampled by 2 ** level (see get_pyramid).
         """
+        if level > 0:
+            pyramid = self.get_pyramid(name)
+            return pyramid[min(level, len(pyramid) - 1)]
+
         if name in CHANNEL_NUM.keys():
             return self.img[CHANNEL_NUM[name], 0 if name == DEFAULT_CHANNEL else 1]
 
-        if name in self.slides:
-            return self.slides[name]
+        slide = self.slides.get(name)
+        if slide is not None:
+            return slide
+
+        slide = self._load_slide(name) if self.persist else None
+        if slide is None:
+            slide = self._restore(name)
+            if self.persist:
+                self._save_slide(name, slide)
+        self.slides[name] = slide
+
+        return slide
 
-        self.slides[name] = self._restore(name)
+    def _stitch_key(self):
+        return self.min_overlap if self.stitch else None
 
-        return self.slides[name]
+    def _slide_path(self, name: str) -> str:
+        return os.path.join(cache_dir(self.path), "slides", str(name))
+
+    def _load_slide(self, name: str):
+        """
+        Memory-maps a slide restored in an earlier session, if its tiles have
+        not changed since.
+        """
+        try:
+            stored = load_array(
+                self._slide_path(name), fingerprint(self[name].values())
+            )
+        except OSError:
+            return None
+        if stored is None:
+            return None
+
+        slide, meta = stored
+        if meta.get("stitch") != self._stitch_key():
+            return None
+
+        self.grids[name] = tuple(np.array(ticks) for ticks in meta["grid"])
+        if "merged" in meta:
+            self.merged[name] = np.array(meta["merged"], dtype=slide.dtype)
+        return slide
+
+    def _save_slide(self, name: str, slide: np.ndarray):
+        """
+        Stores a restored slide (skipped silently for read-only locations).
+        """
+        meta = {
+            "fingerprint": fingerprint(self[name].values()),
+            "grid": [ticks.tolist() for ticks in self.grids[name]],
+            "stitch": self._stitch_key(),
+        }
+        if name in self.merged:
+            meta["merged"] = self.merged[name].tolist()
+        try:
+            save_array(self._slide_path(name), slide, meta)
+        except OSError:
+            pass
 
     def get_tile_overlay(
         self,
@@ -234,7 +503,8 @@ class Codex(Segmentation, Slide):
         """
         background = self.get_tile(x, y, name)
         overlay = self.get_tile(x, y, segmentation)
-        labeled = render_label(overlay, img=background)
+        with span("render_label"):
+            labeled = render_label(overlay, img=background)
 
         if to_rgb:
             return rgba2rgb(labeled)
@@ -243,47 +513,158 @@ class Codex(Segmentation, Slide):
 
     def get_slide_overlay(
         self,
-        x: int,
-        y: int,
+        xlim: Union[None, tuple] = None,
+        ylim: Union[None, tuple] = None,
         name: Union[None, np.ndarray] = DEFAULT_CHANNEL,
         segmentation: str = DEFAULT_SEGMENTATION,
         to_rgb: bool = True,
+        margin: int = 16,
     ) -> np.ndarray:
         """
-        Prediction overlay tiles.
+        Prediction overlay of the slide. If xlim (columns) or ylim (rows) are given
+        as [start, stop) only that window (plus a margin that is cropped off
+        afterwards) is rendered, normalized with the intensity range of the whole
+        slide so it looks the same in every window.
         """
         background = self.get_slide(name)
         overlay = self.get_slide(segmentation)
-        labeled = render_label(overlay, img=background)
+
+        if xlim is None and ylim is None:
+            with span("render_label"):
+                labeled = render_label(overlay, img=background)
+        else:
+            xlim = (0, background.shape[1]) if xlim is None else xlim
+            ylim = (0, background.shape[0]) if ylim is None else ylim
+            rows, cols = get_window(
+                background.shape, xlim, ylim, margin=margin, inclusive=False
+            )
+            inner_rows, inner_cols = get_window(
+                background.shape, xlim, ylim, inclusive=False
+            )
+            # normalized like the whole slide, not just the window
+            window = normalize_range(background[rows, cols], *self.get_range(name))
+            with span("render_label"):
+                labeled = render_label(
+                    overlay[rows, cols], img=window, normalize_img=False
+                )
+            labeled = labeled[
+                inner_rows.start - rows.start : inner_rows.stop - rows.start,
+                inner_cols.start - cols.start : inner_cols.stop - cols.start,
+            ]
 
         if to_rgb:
             return rgba2rgb(labeled)
 
         return labeled
 
-    def get_border_cells(self):
+    def get_range(self, name: Union[None, str] = DEFAULT_CHANNEL) -> tuple:
+        """
+        Returns the intensity range (see helper.intensity_range) of a slide that
+        windows of it are normalized with.
+        """
+        if name not in self.intensity_ranges:
+            self.intensity_ranges[name] = intensity_range(self.get_slide(name))
+        return self.intensity_ranges[name]
+
+    def get_pyramid(self, name: Union[None, str] = DEFAULT_CHANNEL):
+        """
+        Returns the image pyramid [slide, slide / 2, slide / 4, ...] of a layer.
+        Segmentations get a label-preserving (nearest neighbour) pyramid. The
+        levels are cached like slides and, with persist, stored on disk.
+        """
+        slide = self.get_slide(name)
+        levels = self.pyramid_levels.get(name, 0)
+        if levels > 0 and all((name, i) in self.slides for i in range(1, levels + 1)):
+            return [slide] + [self.slides[(name, i)] for i in range(1, levels + 1)]
+
+        labels = name is not None and name not in CHANNEL_NUM.keys()
+        folder = os.path.join(cache_dir(self.path), "pyramid", str(name))
+        key = self._pyramid_key(name, slide) if self.persist else None
+        pyramid = load_pyramid(folder, slide, key) if self.persist else None
+        if pyramid is None:
+            pyramid = build_pyramid(slide, labels=labels)
+            if self.persist:
+                try:
+                    save_pyramid(folder, pyramid, key)
+                except OSError:
+                    pass
+
+        for i, img in enumerate(pyramid[1:], 1):
+            self.slides[(name, i)] = img
+        self.pyramid_levels[name] = len(pyramid) - 1
+
+        return pyramid
+
+    def _pyramid_key(self, name: Union[None, str], slide: np.ndarray) -> dict:
+        """
+        Identifies the source of a stored pyramid: the tiles and stitch setting
+        of a segmentation, a small thumbnail of a channel (hashing the full slide
+        would cost as much as reading it).
+        """
+        if name in CHANNEL_NUM.keys():
+            sample = thumbnail(slide, max_pixels=2**16)
+            return {"digest": hashlib.sha1(sample.data).hexdigest()}
+
+        return {
+            "fingerprint": fingerprint(self[name].values()),
+            "stitch": self._stitch_key(),
+        }
+
+    def get_grid(self, name: Union[None, str] = DEFAULT_SEGMENTATION):
         """
-        Returns the ids from cells that touched the border of slide.
+        Returns the x and y ticks of the tile grid of a slide.
         """
-        # Refactor (?)
-        x_max, y_max = np.array(list(self[DEFAULT_SEGMENTATION].keys())).max(axis=0)
+        if name in CHANNEL_NUM.keys():
+            offset = 0 if self.offset is None else self.offset
+            return self.x_ticks + offset, self.y_ticks + offset
 
-        long_tiles = []
-        for y in range(y_max + 1):
-            long_tiles.append([])
-            for x in range(x_max + 1):
-                tile = np.zeros_like(self.get_tile(x, y, name=DEFAULT_SEGMENTATION))
-                # print(tile.shape)
-                tile[0, :] = 1
-                tile[-1, :] = 1
-                tile[:, 0] = 1
-                tile[:, -1] = 1
-                long_tiles[-1].append(tile)
+        if name not in self.grids:
+            self.get_slide(name)
 
-        long_tiles = [np.hstack(i) for i in long_tiles]
-        full_tiles = np.vstack(long_tiles)
-        m, n = np.where(full_tiles == 1)
-        slide = self.get_slide(DEFAULT_SEGMENTATION)
+        return self.grids[name]
+
+    def get_border_cells(
+        self, segmentation: str = DEFAULT_SEGMENTATION, per_tile: bool = False
+    ):
+        """
+        Returns the ids from cells that touched the border of a tile. Only the
+        boundary rows and columns of the restored slide are read. Cells that were
+        stitched across tile edges only count if they touch the slide border. With
+        per_tile=True a dict from tile (x, y) to its border cell ids is returned.
+        """
+        slide = self.get_slide(segmentation)
+        x_ticks, y_ticks = self.get_grid(segmentation)
+
+        merged = self.merged.get(segmentation, ())
+        if len(merged) > 0:
+            outer = np.unique(
+                np.concatenate([slide[[0, -1]].ravel(), slide[:, [0, -1]].ravel()])
+            )
+
+        def keep(cell_ids):
+            # merged cells only count where they touch the slide border
+            if len(merged) == 0:
+                return cell_ids
+            return np.union1d(
+                np.setdiff1d(cell_ids, merged), np.intersect1d(cell_ids, outer)
+            )
+
+        if per_tile:
+            border_cells = {}
+            for x, y in self[segmentation].keys():
+                tile = slide[y_ticks[y] : y_ticks[y + 1], x_ticks[x] : x_ticks[x + 1]]
+                cell_ids = keep(
+                    np.unique(
+                        np.concatenate([tile[0], tile[-1], tile[:, 0], tile[:, -1]])
+                    )
+                )
+                border_cells[(x, y)] = cell_ids[cell_ids > 0]
+            return border_cells
+
+        rows = np.unique(np.concatenate([y_ticks[:-1], y_ticks[1:] - 1]))
+        cols = np.unique(np.concatenate([x_ticks[:-1], x_ticks[1:] - 1]))
+        cell_ids = keep(
+            np.unique(np.concatenate([slide[rows].ravel(), slide[:, cols].ravel()]))
+        )
 
-        cell_ids = np.unique(slide[m, n])
         return cell_ids[cell_ids > 0]
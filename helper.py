@@ -1,86 +1,194 @@
 import os
+from collections.abc import Mapping
+from functools import lru_cache
 from glob import glob
 
+import numpy as np
 import pandas as pd
+import tifffile
 from skimage.io import imread
 
-CODEX_FOLDER = "/home/voehring/voehring/projects/2022-02-18_codex"
-IMG_PATH_FULL = "/g/huber/projects/CITEseq/CODEX/TIFs/"
-IMG_PATH_DOWN = "/g/huber/projects/CITEseq/CODEX/TIFs_downsized"
-RESOLUTION = 0.377442  # micron
-# downsized paths
-IMG_FULL = {
-    p.split("/")[-1].split(".")[0]: p
-    for p in glob(os.path.join(IMG_PATH_FULL, "*.tif"))
-}
-IMG_DOWN = {
-    p.split("/")[-1].split(".")[0]: p
-    for p in glob(os.path.join(IMG_PATH_DOWN, "*.tif"))
-}
+from codex.timing import timed
 
-channels_full = (
-    pd.read_csv(os.path.join(CODEX_FOLDER, "channelnames.txt"), header=None)
-    .assign(dim0=lambda df: [i for i in range(int(df.shape[0] / 2))] * 2)
-    .assign(dim1=lambda df: [0, 1] * int(df.shape[0] / 2))
-    .rename(columns={0: "marker"})
+# the data paths can be set through the environment or with configure()
+CODEX_FOLDER = os.environ.get(
+    "CODEX_FOLDER", "/home/voehring/voehring/projects/2022-02-18_codex"
+)
+IMG_PATH_FULL = os.environ.get(
+    "CODEX_IMG_PATH_FULL", "/g/huber/projects/CITEseq/CODEX/TIFs/"
 )
+IMG_PATH_DOWN = os.environ.get(
+    "CODEX_IMG_PATH_DOWN", "/g/huber/projects/CITEseq/CODEX/TIFs_downsized"
+)
+RESOLUTION = 0.377442  # micron
 
-CHANNELS = pd.read_csv(
-    os.path.join(CODEX_FOLDER, "channelnames_ch2.txt"), header=None
-).rename(columns={0: "marker"})
+DEFAULT_CHANNEL = "Hoechst"
+DEFAULT_SEGMENTATION = "lgbm_test_sub2"
 
-ANNOTATIONS = pd.read_csv(
-    os.path.join(CODEX_FOLDER, "CODEX_panel_TMA_191.csv"), sep=";", skiprows=2
-).drop(columns="Unnamed: 15")
 
-META = (
-    pd.read_csv(
-        os.path.join(CODEX_FOLDER, "Daten 191_191_1-5-Table 1.csv"), sep=";", header=1
-    )
-    .rename(
-        columns={
-            "TMA-Nr/\nAnzahl": "tma_n",
-            "TMA-Position": "tma_dim0",
-            "Unnamed: 2": "tma_dim1",
-            "Unnamed: 3": "patient_id",
-            "Histo-Nr ": "histo",
-            "Eingangs-\ndatum": "date",
-            "Lokalisation": "loc",
-            "Diagnose": "entity",
-            "Diagnose_lang": "diagnosis",
-            "Geschlecht": "sex",
-            "Alter": "age",
-        }
+class LazyDict(Mapping):
+    """
+    Read-only dict whose content is built by loader on first access.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getitem__(self, key):
+        return self._loader()[key]
+
+    def __iter__(self):
+        return iter(self._loader())
+
+    def __len__(self):
+        return len(self._loader())
+
+    def __repr__(self):
+        return repr(self._loader())
+
+
+def _tifs(path):
+    return {
+        p.split("/")[-1].split(".")[0]: p for p in glob(os.path.join(path, "*.tif"))
+    }
+
+
+@lru_cache(maxsize=None)
+def get_img_full():
+    return _tifs(IMG_PATH_FULL)
+
+
+# downsized paths
+@lru_cache(maxsize=None)
+def get_img_down():
+    return _tifs(IMG_PATH_DOWN)
+
+
+@lru_cache(maxsize=None)
+def get_channels_full():
+    return (
+        pd.read_csv(os.path.join(CODEX_FOLDER, "channelnames.txt"), header=None)
+        .assign(dim0=lambda df: [i for i in range(int(df.shape[0] / 2))] * 2)
+        .assign(dim1=lambda df: [0, 1] * int(df.shape[0] / 2))
+        .rename(columns={0: "marker"})
     )
-    .assign(tma_n=lambda df: df["tma_n"].fillna(method="ffill"))
-    .assign(date=lambda df: df["date"].fillna(method="ffill"))
-    .assign(loc=lambda df: df["loc"].fillna(method="ffill"))
-    .assign(entity=lambda df: df["entity"].fillna(method="ffill"))
-    .assign(diagnosis=lambda df: df["diagnosis"].fillna(method="ffill"))
-    .assign(sex=lambda df: df["sex"].fillna(method="ffill"))
-    .assign(age=lambda df: df["age"].fillna(method="ffill"))
-    .dropna()
-)
 
-TMA = (
-    pd.read_csv(
-        "/home/voehring/voehring/projects/2022-02-18_codex/Montage_key-Table 1.csv",
-        sep=";",
+
+@lru_cache(maxsize=None)
+def get_channels():
+    return pd.read_csv(
+        os.path.join(CODEX_FOLDER, "channelnames_ch2.txt"), header=None
+    ).rename(columns={0: "marker"})
+
+
+@lru_cache(maxsize=None)
+def get_annotations():
+    return pd.read_csv(
+        os.path.join(CODEX_FOLDER, "CODEX_panel_TMA_191.csv"), sep=";", skiprows=2
+    ).drop(columns="Unnamed: 15")
+
+
+@lru_cache(maxsize=None)
+def get_meta():
+    return (
+        pd.read_csv(
+            os.path.join(CODEX_FOLDER, "Daten 191_191_1-5-Table 1.csv"),
+            sep=";",
+            header=1,
+        )
+        .rename(
+            columns={
+                "TMA-Nr/\nAnzahl": "tma_n",
+                "TMA-Position": "tma_dim0",
+                "Unnamed: 2": "tma_dim1",
+                "Unnamed: 3": "patient_id",
+                "Histo-Nr ": "histo",
+                "Eingangs-\ndatum": "date",
+                "Lokalisation": "loc",
+                "Diagnose": "entity",
+                "Diagnose_lang": "diagnosis",
+                "Geschlecht": "sex",
+                "Alter": "age",
+            }
+        )
+        .assign(tma_n=lambda df: df["tma_n"].fillna(method="ffill"))
+        .assign(date=lambda df: df["date"].fillna(method="ffill"))
+        .assign(loc=lambda df: df["loc"].fillna(method="ffill"))
+        .assign(entity=lambda df: df["entity"].fillna(method="ffill"))
+        .assign(diagnosis=lambda df: df["diagnosis"].fillna(method="ffill"))
+        .assign(sex=lambda df: df["sex"].fillna(method="ffill"))
+        .assign(age=lambda df: df["age"].fillna(method="ffill"))
+        .dropna()
     )
-    .iloc[:, :11]
-    .assign(
-        Name=lambda df: df.apply(
-            lambda row: f"{row['TMA']}_{row['Row']}{row['Col']}", 1
+
+
+@lru_cache(maxsize=None)
+def get_tma():
+    return (
+        pd.read_csv(os.path.join(CODEX_FOLDER, "Montage_key-Table 1.csv"), sep=";")
+        .iloc[:, :11]
+        .assign(
+            Name=lambda df: df.apply(
+                lambda row: f"{row['TMA']}_{row['Row']}{row['Col']}", 1
+            )
         )
     )
-)
 
 
-DEFAULT_CHANNEL = "Hoechst"
-DEFAULT_SEGMENTATION = "lgbm_test_sub2"
-NUM_CHANNEL = {i: marker for i, marker in enumerate(CHANNELS.marker.tolist())}
-CHANNEL_NUM = {marker: i for i, marker in enumerate(CHANNELS.marker.tolist())}
-CHANNEL_NUM[DEFAULT_CHANNEL] = 0
+@lru_cache(maxsize=None)
+def get_num_channel():
+    return {i: marker for i, marker in enumerate(get_channels().marker.tolist())}
+
+
+@lru_cache(maxsize=None)
+def get_channel_num():
+    channel_num = {marker: i for i, marker in enumerate(get_channels().marker.tolist())}
+    channel_num[DEFAULT_CHANNEL] = 0
+    return channel_num
+
+
+IMG_FULL = LazyDict(get_img_full)
+IMG_DOWN = LazyDict(get_img_down)
+NUM_CHANNEL = LazyDict(get_num_channel)
+CHANNEL_NUM = LazyDict(get_channel_num)
+
+# tables that are parsed on first attribute access, e.g. helper.TMA
+_TABLES = {
+    "channels_full": get_channels_full,
+    "CHANNELS": get_channels,
+    "ANNOTATIONS": get_annotations,
+    "META": get_meta,
+    "TMA": get_tma,
+}
+
+
+def __getattr__(name):
+    if name in _TABLES:
+        return _TABLES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def configure(codex_folder=None, img_path_full=None, img_path_down=None):
+    """
+    Sets the data paths and drops all tables that were parsed so far.
+    """
+    global CODEX_FOLDER, IMG_PATH_FULL, IMG_PATH_DOWN
+
+    if codex_folder is not None:
+        CODEX_FOLDER = codex_folder
+    if img_path_full is not None:
+        IMG_PATH_FULL = img_path_full
+    if img_path_down is not None:
+        IMG_PATH_DOWN = img_path_down
+
+    for loader in [get_img_full, get_img_down, get_num_channel, get_channel_num]:
+        loader.cache_clear()
+    for loader in _TABLES.values():
+        loader.cache_clear()
+
+
+def core_name(row) -> str:
+    return f"{row['TMA']}_{row['Row']}{row['Col']}"
 
 
 def crop_tma(img, row=0, col=0, nrows=3, ncols=2):
@@ -90,13 +198,87 @@ def crop_tma(img, row=0, col=0, nrows=3, ncols=2):
     ]
 
 
-def load_tma(tma):
-    path = IMG_FULL[TMA.iloc[tma].loc["TMA"]]
-    img = imread(path)
+def get_window(shape, xlim, ylim, margin=0, inclusive=True):
+    """
+    Returns the (row, column) slices covering xlim and ylim (plus margin pixels)
+    clipped to an image of the given shape. With inclusive=False the upper
+    limits are exclusive like in a slice.
+    """
+    height, width = shape[-2:]
+    end = margin + (1 if inclusive else 0)
+    rows = slice(
+        min(max(int(ylim[0]) - margin, 0), height),
+        min(max(int(ylim[1]) + end, 0), height),
+    )
+    cols = slice(
+        min(max(int(xlim[0]) - margin, 0), width),
+        min(max(int(xlim[1]) + end, 0), width),
+    )
+    return rows, cols
+
+
+def thumbnail(img, max_pixels: int = 2**20):
+    """
+    Returns a regular subsample of an image with at most about max_pixels.
+    """
+    step = max(int(np.ceil(np.sqrt(img.shape[0] * img.shape[1] / max_pixels))), 1)
+    return np.ascontiguousarray(img[::step, ::step])
+
+
+def intensity_range(img, low: float = 3, high: float = 99.8) -> tuple:
+    """
+    Returns the low and high percentiles of a slide (those render_label
+    normalizes with), estimated on a thumbnail.
+    """
+    vmin, vmax = np.percentile(thumbnail(img), [low, high])
+    return float(vmin), float(vmax)
+
+
+def normalize_range(img, vmin: float, vmax: float):
+    """
+    Scales an image (e.g. a window of a slide) to the intensity range of its
+    slide, so every window of the slide is rendered with the same contrast.
+    """
+    return (np.asarray(img, dtype=np.float32) - vmin) / (vmax - vmin + 1e-20)
+
+
+@timed("read_tma")
+def read_tma(path: str, lazy: bool = True):
+    """
+    Opens a (multi-channel) TMA tiff. With lazy=True nothing is decoded up front:
+    uncompressed files are memory-mapped, otherwise a zarr array is returned that
+    only decodes the strips/tiles overlapping the requested region. Both support
+    the same indexing as the array returned by imread.
+    """
+    if not lazy:
+        return imread(path)
+
+    try:
+        return tifffile.memmap(path, mode="r")
+    except ValueError:
+        pass
+
+    try:
+        import zarr
+    except ImportError:
+        return imread(path)
+
+    img = zarr.open(tifffile.imread(path, aszarr=True), mode="r")
+    if isinstance(img, zarr.Group):
+        # pyramidal tiff, use the full resolution level
+        img = img["0"]
+
+    return img
+
+
+def load_tma(tma, lazy=True):
+    row = get_tma().iloc[tma]
+    path = IMG_FULL[row.loc["TMA"]]
+    img = read_tma(path, lazy=lazy)
     return crop_tma(
         img,
-        TMA.iloc[tma].loc["Row"],
-        TMA.iloc[tma].loc["Col"],
-        nrows=TMA.iloc[tma].loc["Nrows"],
-        ncols=TMA.iloc[tma].loc["Ncols"],
+        row.loc["Row"],
+        row.loc["Col"],
+        nrows=row.loc["Nrows"],
+        ncols=row.loc["Ncols"],
     )
@@ -0,0 +1,159 @@
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Union
+
+from codex.timing import timed
+
+MANIFEST = "index.json"
+MANIFEST_VERSION = 1
+
+
+def get_x_and_y(name):
+    x, y = os.path.splitext(name)[0].split("_")[-2:]
+    return int(x), int(y)
+
+
+def segmented_dir(path: str) -> str:
+    return os.path.normpath(path) + "_segmented"
+
+
+def cache_dir(path: str) -> str:
+    """
+    Folder next to <path> and <path>_segmented that holds derived data.
+    """
+    return os.path.normpath(path) + "_cache"
+
+
+def _scan_pngs(path: str, files: list, mtimes: dict):
+    """
+    Recursively collects the png files below path (like glob("**/*.png")).
+    """
+    mtimes[path] = os.stat(path).st_mtime_ns
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                _scan_pngs(entry.path, files, mtimes)
+            elif entry.name.endswith(".png"):
+                files.append(entry.path)
+
+
+def _sorted_index(files) -> OrderedDict:
+    return OrderedDict(
+        (get_x_and_y(f), f) for f in sorted(files, key=lambda f: get_x_and_y(f)[::-1])
+    )
+
+
+@timed("scan_folder")
+def scan_folder(path: str):
+    """
+    Indexes the source tiles in path and the tiles of every segmentation in
+    <path>_segmented. Returns the index and the mtimes of all scanned folders.
+    """
+    path = os.path.normpath(path)
+    index, mtimes = {}, {}
+
+    source_files = []
+    _scan_pngs(path, source_files, mtimes)
+    index[None] = _sorted_index(source_files)
+
+    segmented_path = segmented_dir(path)
+    mtimes[segmented_path] = os.stat(segmented_path).st_mtime_ns
+    with os.scandir(segmented_path) as entries:
+        sub_dirs = [e.path for e in entries if e.is_dir()]
+
+    for sub_dir in sub_dirs:
+        mtimes[sub_dir] = os.stat(sub_dir).st_mtime_ns
+        with os.scandir(sub_dir) as entries:
+            files = [e.path for e in entries if not e.name.startswith(".")]
+        index[os.path.basename(sub_dir)] = _sorted_index(files)
+
+    return index, mtimes
+
+
+def _is_fresh(mtimes: dict) -> bool:
+    try:
+        return all(os.stat(p).st_mtime_ns == t for p, t in mtimes.items())
+    except OSError:
+        return False
+
+
+def read_manifest(path: str) -> Union[None, dict]:
+    """
+    Returns the cached index of path or None if it is missing or stale.
+    """
+    try:
+        with open(os.path.join(cache_dir(path), MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION or not _is_fresh(manifest["mtimes"]):
+        return None
+
+    return {
+        name: OrderedDict((tuple(key), f) for key, f in tiles)
+        for name, tiles in manifest["index"]
+    }
+
+
+def write_manifest(path: str, index: dict, mtimes: dict):
+    """
+    Stores the index of path, silently skipping read-only locations.
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "mtimes": mtimes,
+        "index": [
+            [name, [[list(key), f] for key, f in tiles.items()]]
+            for name, tiles in index.items()
+        ],
+    }
+    target = os.path.join(cache_dir(path), MANIFEST)
+    try:
+        os.makedirs(cache_dir(path), exist_ok=True)
+        with open(target + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(target + ".tmp", target)
+    except OSError:
+        pass
+
+
+def index_folder(path: str, use_manifest: bool = True) -> dict:
+    """
+    Returns the tile index of path, read from its manifest if it is up to date
+    and rebuilt (and stored) otherwise.
+    """
+    if use_manifest:
+        index = read_manifest(path)
+        if index is not None:
+            return index
+
+    index, mtimes = scan_folder(path)
+    if use_manifest:
+        write_manifest(path, index, mtimes)
+
+    return index
+
+
+@timed("scan_cohort")
+def scan_cohort(
+    root: str, use_manifest: bool = True, folders: Union[None, Iterable[str]] = None
+) -> Dict[str, dict]:
+    """
+    Indexes every tile folder (those with a <name>_segmented sibling) of a
+    cohort directory in one sweep, or only those named in folders. Returns a
+    dict from folder path to index.
+    """
+    with os.scandir(root) as entries:
+        names = {e.name for e in entries if e.is_dir()}
+
+    candidates = names if folders is None else names & set(folders)
+    paths = [
+        os.path.normpath(os.path.join(root, name))
+        for name in sorted(candidates)
+        if name + "_segmented" in names
+    ]
+    return {path: index_folder(path, use_manifest=use_manifest) for path in paths}
@@ -3,11 +3,19 @@ import bokeh
 import bokeh.io
 import bokeh.plotting as bk
 import numpy as np
-from bokeh.models import Label
+from bokeh.application import Application
+from bokeh.application.handlers import FunctionHandler
+from bokeh.events import RangesUpdate
+from bokeh.models import ColumnDataSource, Label, LinearColorMapper, Range1d
+from bokeh.palettes import Greys256
+from bokeh.server.server import Server
+from stardist.plot import render_label
 
 from codex.experiment import Codex
-from codex.helper import DEFAULT_CHANNEL
+from codex.helper import DEFAULT_CHANNEL, normalize_range
+from codex.pyramid import count_levels, window_level
 from codex.quantify import quantify_segmentation
+from codex.spatial import cells_in_window
 
 
 def interactive_tile(
@@ -141,8 +149,21 @@ def interactive_slide(
     plots = []
 
     for i, name in enumerate(names):
-        im_full = experiment.get_slide(name=name)
-        im = im_full[xmin:xmax, ymin:ymax]
+        # use the coarsest pyramid level that still fills the frame, the
+        # pyramid is only built if that is not the full resolution slide
+        levels = experiment.pyramid_levels.get(name)
+        if levels is None:
+            levels = count_levels(experiment.get_slide(name).shape)
+        level = window_level(
+            (xmax - xmin, ymax - ymin),
+            xmax - xmin if frame_height is None else frame_height,
+            ymax - ymin if frame_width is None else frame_width,
+            levels,
+        )
+        factor = 2**level
+        im = experiment.get_slide(name, level=level)[
+            xmin // factor : xmax // factor, ymin // factor : ymax // factor
+        ]
 
         p = bebi103.image.imshow(
             im,
@@ -151,9 +172,9 @@ def interactive_slide(
             colorbar=colorbar,
             title=name if name is not None else "Hoechst",
             cmap=color_mapper,
-            interpixel_distance=interpixel_distances
+            interpixel_distance=factor * interpixel_distances
             if interpixel_distances is not None
-            else 1.0,
+            else factor,
             length_units=length_units,
             max_intensity=max_intensity[i]
             if max_intensity is not None
@@ -207,15 +228,18 @@ def interactive_labeled_slide(
     ncols: int = 4,
     quantify: bool = True,
     raw_plots: bool = False,
+    index=None,
 ):
     """Convenient function for showing two images side by side."""
     plots = []
 
-    sub = df[(df.x > xmin) & (df.x < xmax) & (df.y > ymin) & (df.y < ymax)]
+    sub = cells_in_window(df, (xmin, xmax), (ymin, ymax), index=index)
 
     for i, name in enumerate(names):
-        # im = experiment.get_slide(name=name)
-        im = experiment.get_slide_overlay(name=name)[..., xmin:xmax, ymin:ymax]
+        # only the window is rendered
+        im = experiment.get_slide_overlay(
+            xlim=(xmin, xmax), ylim=(ymin, ymax), name=name
+        )
 
         p = bebi103.image.imshow(
             im,
@@ -235,8 +259,8 @@ def interactive_labeled_slide(
         if quantify:
             for i, row in sub.iterrows():
                 label = Label(
-                    x=row["x"],
-                    y=im.shape[1] - row["y"],
+                    x=row["x"] - xmin,
+                    y=im.shape[0] - (row["y"] - ymin),
                     x_offset=-5,
                     y_offset=0,
                     text=f"{int(row['id'])}",
@@ -350,3 +374,180 @@ def show_mult_ims(
         plot.y_range = plots[0].y_range
 
     return bokeh.layouts.gridplot(plots, ncols=ncols)
+
+
+def _visible_window(shape, x0, x1, y0, y1):
+    """
+    Returns the (row, column) slices of a slide visible within the ranges.
+    """
+    height, width = shape
+    rows = slice(
+        int(np.clip(np.floor(min(y0, y1)), 0, height)),
+        int(np.clip(np.ceil(max(y0, y1)), 0, height)),
+    )
+    cols = slice(
+        int(np.clip(np.floor(min(x0, x1)), 0, width)),
+        int(np.clip(np.ceil(max(x0, x1)), 0, width)),
+    )
+    return rows, cols
+
+
+def _render_window(experiment, name, segmentation, rows, cols, height, width):
+    """
+    Returns the visible window of a slide (or of its overlay with segmentation)
+    from the coarsest pyramid level that still fills height x width pixels,
+    together with the downsampling factor.
+    """
+    pyramid = experiment.get_pyramid(name)
+    level = window_level(
+        (rows.stop - rows.start, cols.stop - cols.start),
+        height,
+        width,
+        len(pyramid) - 1,
+    )
+    factor = 2**level
+    window = (
+        slice(rows.start // factor, -(-rows.stop // factor)),
+        slice(cols.start // factor, -(-cols.stop // factor)),
+    )
+    im = np.asarray(pyramid[level][window])
+    if segmentation is None:
+        return im, factor
+
+    # segmentations start at the offset of the channels, the labels are placed
+    # into the frame of the intensity window (no label outside them)
+    shift = 0 if experiment.offset is None else experiment.offset // factor
+    level_labels = experiment.get_pyramid(segmentation)[level]
+    labels = np.zeros(im.shape[:2], dtype=level_labels.dtype)
+    src, dst = [], []
+    for axis, w in enumerate(window):
+        start = max(w.start - shift, 0)
+        stop = min(w.start - shift + im.shape[axis], level_labels.shape[axis])
+        stop = max(stop, start)
+        src.append(slice(start, stop))
+        dst.append(slice(start - (w.start - shift), stop - (w.start - shift)))
+    labels[tuple(dst)] = level_labels[tuple(src)]
+
+    # the same contrast at every position and zoom
+    im = normalize_range(im, *experiment.get_range(name))
+    rgba = (render_label(labels, img=im, normalize_img=False) * 255).astype(np.uint8)
+    return rgba.view(np.uint32)[..., 0], factor
+
+
+def slide_viewer(
+    experiment: Codex,
+    names: list = [DEFAULT_CHANNEL],
+    segmentation: str = None,
+    frame_height: int = 600,
+    frame_width: int = 600,
+    palette=Greys256,
+    max_intensity: int = None,
+):
+    """
+    Returns a Bokeh application function (modify_doc) that shows whole slides
+    and re-renders whenever the view is panned or zoomed. Only the visible part
+    of the slide is sent to the browser, taken from the pyramid level matching
+    the screen resolution. With segmentation the labels are rendered on top.
+
+    Run it on a local Bokeh server, e.g. with show_slide_viewer in a notebook
+    or serve_slide_viewer from a script.
+    """
+
+    def modify_doc(doc):
+        height, width = experiment.get_slide(names[0]).shape[:2]
+        rows, cols = slice(0, height), slice(0, width)
+
+        def render(name, rows, cols):
+            im, factor = _render_window(
+                experiment, name, segmentation, rows, cols, frame_height, frame_width
+            )
+            return dict(
+                image=[im],
+                x=[cols.start // factor * factor],
+                y=[rows.start // factor * factor],
+                dw=[im.shape[1] * factor],
+                dh=[im.shape[0] * factor],
+            )
+
+        # y points down like in the image
+        x_range = Range1d(0, width, bounds=(0, width))
+        y_range = Range1d(height, 0, bounds=(0, height))
+        sources, plots = [], []
+        for name in names:
+            source = ColumnDataSource(render(name, rows, cols))
+            p = bk.figure(
+                frame_height=frame_height,
+                frame_width=frame_width,
+                x_range=x_range,
+                y_range=y_range,
+                title=name,
+                match_aspect=True,
+                tools="pan,wheel_zoom,box_zoom,reset",
+                active_scroll="wheel_zoom",
+            )
+            if segmentation is None:
+                # the intensity range is fixed by the coarsest level
+                coarse = experiment.get_pyramid(name)[-1]
+                mapper = LinearColorMapper(
+                    palette=palette,
+                    low=np.min(coarse),
+                    high=(
+                        np.quantile(coarse, 0.99)
+                        if max_intensity is None
+                        else max_intensity
+                    ),
+                )
+                p.image(
+                    "image",
+                    x="x",
+                    y="y",
+                    dw="dw",
+                    dh="dh",
+                    source=source,
+                    color_mapper=mapper,
+                )
+            else:
+                p.image_rgba("image", x="x", y="y", dw="dw", dh="dh", source=source)
+            sources.append(source)
+            plots.append(p)
+
+        def update(event):
+            rows, cols = _visible_window(
+                (height, width), event.x0, event.x1, event.y0, event.y1
+            )
+            if rows.stop <= rows.start or cols.stop <= cols.start:
+                return
+
+            for name, source in zip(names, sources):
+                source.data = render(name, rows, cols)
+
+        plots[0].on_event(RangesUpdate, update)
+        doc.add_root(bokeh.layouts.row(plots))
+
+    return modify_doc
+
+
+def show_slide_viewer(
+    experiment: Codex, notebook_url: str = "localhost:8888", **kwargs
+):
+    """
+    Shows the slide viewer in a notebook (the notebook starts the server).
+    """
+    bokeh.io.show(slide_viewer(experiment, **kwargs), notebook_url=notebook_url)
+
+
+def serve_slide_viewer(
+    experiment: Codex, port: int = 5006, show: bool = True, **kwargs
+):
+    """
+    Serves the slide viewer on a local Bokeh server at http://localhost:port
+    until interrupted.
+    """
+    server = Server(
+        {"/": Application(FunctionHandler(slide_viewer(experiment, **kwargs)))},
+        port=port,
+    )
+    server.start()
+    if show:
+        server.io_loop.add_callback(server.show, "/")
+    server.io_loop.start()
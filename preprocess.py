@@ -0,0 +1,136 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Union
+
+import cv2
+import numpy as np
+
+from codex.helper import CHANNEL_NUM
+
+
+class Step:
+    """
+    A preprocessing step. Configured OpenCV objects are created once per thread
+    (they are not thread-safe) and reused for every tile.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def params(self) -> dict:
+        return {k: v for k, v in vars(self).items() if not k.startswith("_")}
+
+    def operator(self):
+        op = getattr(self._local, "op", None)
+        if op is None:
+            op = self._local.op = self.create()
+        return op
+
+    def create(self):
+        return None
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def __repr__(self):
+        params = ", ".join(f"{k}={v!r}" for k, v in sorted(self.params().items()))
+        return f"{type(self).__name__}({params})"
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+
+class CLAHE(Step):
+    def __init__(self, clip_limit: float = 2, tile_grid_size: tuple = (12, 12)):
+        super().__init__()
+        self.clip_limit = clip_limit
+        self.tile_grid_size = tuple(tile_grid_size)
+
+    def create(self):
+        return cv2.createCLAHE(
+            clipLimit=self.clip_limit, tileGridSize=self.tile_grid_size
+        )
+
+    def __call__(self, img):
+        return self.operator().apply(img)
+
+
+class PercentileClip(Step):
+    def __init__(self, low: float = 1, high: float = 99.5):
+        super().__init__()
+        self.low = low
+        self.high = high
+
+    def __call__(self, img):
+        low, high = np.percentile(img, [self.low, self.high])
+        return np.clip(img, low, high).astype(img.dtype)
+
+
+class BackgroundSubtraction(Step):
+    """
+    Removes background that varies slower than the cells by a white top-hat
+    (the image minus its morphological opening) with a disk of radius.
+    """
+
+    def __init__(self, radius: int = 25):
+        super().__init__()
+        self.radius = radius
+
+    def create(self):
+        size = 2 * self.radius + 1
+        return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+
+    def __call__(self, img):
+        return cv2.morphologyEx(img, cv2.MORPH_TOPHAT, self.operator())
+
+
+class Pipeline:
+    """
+    Chain of preprocessing steps, usable as the preprocess_tile hook of Codex.
+    Tiles are cached per (channel, tile, key), key being a hash of the steps
+    and their parameters, so changing the pipeline never returns stale tiles.
+    """
+
+    def __init__(self, steps: List[Step], workers: Union[None, int] = None):
+        self.steps = list(steps)
+        self.workers = workers
+        self.key = hashlib.sha1(repr(self.steps).encode()).hexdigest()[:16]
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        for step in self.steps:
+            img = step(img)
+        return img
+
+    def __repr__(self):
+        return f"Pipeline({self.steps!r})"
+
+    def map(self, imgs: Iterable[np.ndarray]) -> List[np.ndarray]:
+        """
+        Preprocesses images on a thread pool (OpenCV releases the GIL).
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(self, imgs))
+
+    def apply(self, experiment, channels: Union[None, List[str]] = None) -> dict:
+        """
+        Preprocesses every tile of the given channels (default all) of a Codex
+        that uses this pipeline, on its tile reader pool. Returns a dict from
+        channel to its tiles in grid order.
+        """
+        if experiment.preprocess_tile is not self:
+            raise ValueError("The experiment does not use this pipeline.")
+
+        channels = list(CHANNEL_NUM.keys()) if channels is None else channels
+        coords = [
+            (x, y)
+            for y in range(len(experiment.y_ticks) - 1)
+            for x in range(len(experiment.x_ticks) - 1)
+        ]
+        return {channel: experiment.get_tiles(coords, channel) for channel in channels}
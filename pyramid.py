@@ -0,0 +1,119 @@
+import json
+import os
+from typing import List
+
+import numpy as np
+
+
+def downsample(img: np.ndarray, factor: int = 2, labels: bool = False) -> np.ndarray:
+    """
+    Downsamples an image by factor. Intensities are averaged over factor x factor
+    blocks, labels are subsampled (nearest neighbour) so no new ids appear.
+    """
+    height, width = img.shape[0] // factor, img.shape[1] // factor
+    if labels:
+        # crop like the intensities so both pyramids have the same shapes
+        return np.ascontiguousarray(
+            img[: height * factor : factor, : width * factor : factor]
+        )
+
+    blocks = np.asarray(img[: height * factor, : width * factor]).reshape(
+        (height, factor, width, factor) + img.shape[2:]
+    )
+    return blocks.mean(axis=(1, 3)).astype(img.dtype)
+
+
+def build_pyramid(
+    img: np.ndarray, labels: bool = False, min_size: int = 256, factor: int = 2
+) -> List[np.ndarray]:
+    """
+    Returns [img, img / factor, img / factor**2, ...] down to min_size pixels.
+    """
+    pyramid = [img]
+    for _ in range(count_levels(img.shape, min_size=min_size, factor=factor)):
+        pyramid.append(downsample(pyramid[-1], factor=factor, labels=labels))
+
+    return pyramid
+
+
+def count_levels(shape: tuple, min_size: int = 256, factor: int = 2) -> int:
+    """
+    Returns the number of levels > 0 build_pyramid creates for an image of shape.
+    """
+    height, width = shape[:2]
+    levels = 0
+    while min(height, width) // factor >= min_size:
+        height, width = height // factor, width // factor
+        levels += 1
+
+    return levels
+
+
+def choose_level(pyramid: List[np.ndarray], height: int, width: int) -> int:
+    """
+    Returns the coarsest level that still has at least height x width pixels.
+    """
+    level = 0
+    for i, img in enumerate(pyramid):
+        if img.shape[0] >= height and img.shape[1] >= width:
+            level = i
+
+    return level
+
+
+def window_level(
+    window: tuple, height: int, width: int, levels: int, factor: int = 2
+) -> int:
+    """
+    Returns the coarsest level (up to levels) at which a window of the full
+    resolution slide still has at least height x width pixels.
+    """
+    level = 0
+    while (
+        level < levels
+        and window[0] // factor ** (level + 1) >= height
+        and window[1] // factor ** (level + 1) >= width
+    ):
+        level += 1
+
+    return level
+
+
+def save_pyramid(path: str, pyramid: List[np.ndarray], key: dict = None):
+    """
+    Stores the levels > 0 of a pyramid as .npy files in the folder path, with
+    the key identifying the source of the slide (e.g. its tile fingerprint) in
+    pyramid.json. Every file is written to a temporary file first.
+    """
+    os.makedirs(path, exist_ok=True)
+    tmp = f".{os.getpid()}.tmp"
+    for level, img in enumerate(pyramid[1:], 1):
+        target = os.path.join(path, f"{level}.npy")
+        with open(target + tmp, "wb") as f:
+            np.save(f, img)
+        os.replace(target + tmp, target)
+
+    meta = {"shape": list(pyramid[0].shape), "levels": len(pyramid) - 1, "key": key}
+    target = os.path.join(path, "pyramid.json")
+    with open(target + tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(target + tmp, target)
+
+
+def load_pyramid(path: str, img: np.ndarray, key: dict = None) -> List[np.ndarray]:
+    """
+    Loads (memory-maps) a stored pyramid of img, returns None if there is none
+    or it was built from an image of a different shape or key.
+    """
+    try:
+        with open(os.path.join(path, "pyramid.json")) as f:
+            meta = json.load(f)
+        if tuple(meta["shape"]) != img.shape or meta.get("key") != key:
+            return None
+
+        return [img] + [
+            np.load(os.path.join(path, f"{level}.npy"), mmap_mode="r")
+            for level in range(1, meta["levels"] + 1)
+        ]
+    except (OSError, ValueError, KeyError):
+        return None
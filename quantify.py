@@ -1,4 +1,5 @@
 import os
+import time
 from typing import Callable, List, Union
 
 import cv2
@@ -7,6 +8,7 @@ import pandas as pd
 import scipy.ndimage
 from tqdm import tqdm
 
+from codex import timing
 from codex.experiment import Codex
 from codex.helper import CHANNEL_NUM, DEFAULT_CHANNEL
 
@@ -18,7 +20,8 @@ def get_x_and_y(name):
 
 def position(img: np.ndarray, **kwargs):
     y, x = scipy.ndimage.measurements.center_of_mass(img)
-    return {"x": x, "y": y}
+    y_offset, x_offset = kwargs.get("offset", (0, 0))
+    return {"x": x + x_offset, "y": y + y_offset}
 
 
 def size(img: np.ndarray, **kwargs):
@@ -36,6 +39,37 @@ def intensity(img: np.ndarray, **kwargs):
     }
 
 
+def label_intensity(
+    segmentation: np.ndarray, stack: np.ndarray, channels: List[str]
+) -> pd.DataFrame:
+    """
+    Computes mean, std and sum of every channel in the (channel, H, W) stack
+    for all labels at once using label-indexed reductions.
+    """
+    labels = segmentation.ravel()
+    num = labels.max() + 1
+    counts = np.bincount(labels, minlength=num)
+    ids = np.nonzero(counts)[0]
+    ids = ids[ids > 0]
+
+    data = {"id": ids}
+    for channel, img in zip(channels, stack):
+        values = img.ravel().astype(np.float64)
+        sums = np.bincount(labels, weights=values, minlength=num)
+        means = sums / np.maximum(counts, 1)
+        squares = np.bincount(
+            labels, weights=(values - means[labels]) ** 2, minlength=num
+        )
+        if np.issubdtype(img.dtype, np.integer):
+            sums = np.rint(sums).astype(np.int64)
+
+        data[f"{channel} mean"] = means[ids]
+        data[f"{channel} std"] = np.sqrt(squares[ids] / counts[ids])
+        data[f"{channel} sum"] = sums[ids]
+
+    return pd.DataFrame(data)
+
+
 def ellipse(img, **kwargs):
     contours, hierarchy = cv2.findContours(
         img.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
@@ -44,10 +78,11 @@ def ellipse(img, **kwargs):
     if has_ellipse:
         cnt = contours[0]
         ellipse_center, axles, angle = cv2.fitEllipse(cnt)
+        y_offset, x_offset = kwargs.get("offset", (0, 0))
         return {
             "ellipse": 1,
-            "cx": ellipse_center[0],
-            "cy": ellipse_center[1],
+            "cx": ellipse_center[0] + x_offset,
+            "cy": ellipse_center[1] + y_offset,
             "major": axles[0],
             "minor": axles[1],
             "angle": angle,
@@ -70,6 +105,134 @@ def border(img, **kwargs):
     }
 
 
+def bounding_boxes(segmentation: np.ndarray, margin: int = 1):
+    """
+    Yields the label and its bounding box (padded by margin) for every cell
+    in a single pass over the segmentation.
+    """
+    for i, window in enumerate(scipy.ndimage.find_objects(segmentation), 1):
+        if window is None:
+            continue
+
+        yield i, tuple(
+            slice(max(s.start - margin, 0), min(s.stop + margin, n))
+            for s, n in zip(window, segmentation.shape)
+        )
+
+
+def full_windows(segmentation: np.ndarray):
+    """
+    Yields every label up to the maximum together with the full image window.
+    """
+    window = tuple(slice(0, n) for n in segmentation.shape)
+    for i in range(1, segmentation.max() + 1):
+        yield i, window
+
+
+def label_moments(segmentation: np.ndarray, chunk_rows: int = 1024) -> pd.DataFrame:
+    """
+    Computes shape features of all labels at once from their image moments,
+    accumulated with label-indexed bincounts over chunks of rows:
+
+    centroid (x, y), size, the major and minor axis (full lengths) of the
+    ellipse with the same second moments, its orientation angle (degrees of the
+    major axis to the x axis, clockwise as y points down, in [0, 180)),
+    eccentricity, perimeter (number of pixels with a 4-neighbour outside the
+    cell) and whether the cell touches the top, bottom, left or right border.
+    """
+    height, width = segmentation.shape
+    num = int(segmentation.max()) + 1
+
+    def chunks():
+        for start in range(0, height, chunk_rows):
+            chunk = np.asarray(segmentation[start : start + chunk_rows])
+            rows, cols = np.nonzero(chunk)
+            yield start, chunk, rows + start, cols, chunk[rows, cols]
+
+    # raw moments
+    m00, m10, m01 = np.zeros(num), np.zeros(num), np.zeros(num)
+    for _, _, rows, cols, labels in chunks():
+        m00 += np.bincount(labels, minlength=num)
+        m10 += np.bincount(labels, weights=cols, minlength=num)
+        m01 += np.bincount(labels, weights=rows, minlength=num)
+
+    area = np.maximum(m00, 1)
+    cx, cy = m10 / area, m01 / area
+
+    # central moments and boundary pixels
+    mu20, mu02, mu11 = np.zeros(num), np.zeros(num), np.zeros(num)
+    perimeter = np.zeros(num, dtype=np.int64)
+    for start, chunk, rows, cols, labels in chunks():
+        dx, dy = cols - cx[labels], rows - cy[labels]
+        mu20 += np.bincount(labels, weights=dx * dx, minlength=num)
+        mu02 += np.bincount(labels, weights=dy * dy, minlength=num)
+        mu11 += np.bincount(labels, weights=dx * dy, minlength=num)
+
+        # the chunk with one row above and below, outside the image is 0
+        lo, hi = max(start - 1, 0), min(start + len(chunk) + 1, height)
+        block = np.pad(np.asarray(segmentation[lo:hi]), 1)
+        r0, r1 = start - lo + 1, start - lo + 1 + len(chunk)
+        center = block[r0:r1, 1:-1]
+        boundary = (
+            (center != block[r0 - 1 : r1 - 1, 1:-1])
+            | (center != block[r0 + 1 : r1 + 1, 1:-1])
+            | (center != block[r0:r1, :-2])
+            | (center != block[r0:r1, 2:])
+        ) & (center > 0)
+        perimeter += np.bincount(center[boundary], minlength=num)
+
+    a, b, c = mu20 / area, mu11 / area, mu02 / area
+    root = np.sqrt(((a - c) / 2) ** 2 + b**2)
+    major_var, minor_var = (a + c) / 2 + root, np.maximum((a + c) / 2 - root, 0)
+    # single pixels are circles
+    point = major_var == 0
+    major_var[point], minor_var[point] = 1, 1
+
+    ids = np.nonzero(m00)[0]
+    ids = ids[ids > 0]
+
+    def touches(edge):
+        return np.isin(ids, edge).astype(int)
+
+    top, bottom = touches(segmentation[0]), touches(segmentation[height - 1])
+    left = touches(np.asarray(segmentation[:, 0]))
+    right = touches(np.asarray(segmentation[:, width - 1]))
+
+    return pd.DataFrame(
+        {
+            "id": ids,
+            "x": cx[ids],
+            "y": cy[ids],
+            "size": m00[ids].astype(np.int64),
+            "perimeter": perimeter[ids],
+            "ellipse": (m00[ids] >= 5).astype(int),
+            "cx": cx[ids],
+            "cy": cy[ids],
+            "major": np.where(point[ids], 0, 4 * np.sqrt(major_var[ids])),
+            "minor": np.where(point[ids], 0, 4 * np.sqrt(minor_var[ids])),
+            "angle": np.degrees(0.5 * np.arctan2(2 * b[ids], a[ids] - c[ids])) % 180,
+            "eccentricity": np.sqrt(1 - minor_var[ids] / major_var[ids]),
+            "top": top,
+            "bottom": bottom,
+            "left": left,
+            "right": right,
+            "border": top | bottom | left | right,
+        }
+    )
+
+
+ENGINES = {"bbox": bounding_boxes, "full": full_windows}
+
+# columns of label_moments that replace a feature function with engine="moments"
+MOMENT_FEATURES = {
+    position: ["x", "y"],
+    size: ["size", "perimeter"],
+    ellipse: ["ellipse", "cx", "cy", "major", "minor", "angle", "eccentricity"],
+    border: ["top", "bottom", "left", "right", "border"],
+}
+
+
+@timing.timed("quantify_segmentation")
 def quantify_segmentation(
     experiment: Codex,
     x: Union[None, int] = None,
@@ -78,7 +241,26 @@ def quantify_segmentation(
     funcs: List[Callable] = [position, size, ellipse, border],
     segmentation: str = "lgbm_test_sub2",
     channels: bool = False,
+    engine: str = "bbox",
+    batch_channels: bool = True,
+    progress: bool = True,
 ):
+    """
+    Quantifies every cell of a slide (or of the tile at x, y).
+
+    With engine="bbox" the features are computed on each cell's bounding box
+    (found in one pass) and labels without any pixels are skipped, with
+    engine="full" on a full-size mask for every label up to the maximum. With
+    engine="moments" the default feature functions are replaced by columns of
+    label_moments, computed for all cells at once (the ellipse is then the one
+    with the same second moments rather than a fit to the contour); other
+    functions still run per cell on bounding boxes.
+    Feature functions receive the cropped mask and original image together
+    with the offset of the crop in the keyword "offset". With channels=True
+    and batch_channels=True the intensities of all channels are computed in a
+    single sweep over the channel stack instead of once per cell. If timing is
+    enabled the time spent in every feature function is recorded.
+    """
     if x is None and y is None:
         segmentation = experiment.get_slide(segmentation)
         original = experiment.get_slide()
@@ -86,28 +268,73 @@ def quantify_segmentation(
         segmentation = experiment.get_tile(x, y, segmentation)
         original = experiment.get_tile(x, y)
 
+    channel_imgs = {}
+    if channels:
+        for channel in CHANNEL_NUM.keys():
+            if x is None and y is None:
+                channel_imgs[channel] = experiment.get_slide(name=channel)
+            else:
+                channel_imgs[channel] = experiment.get_tile(x, y, name=channel)
+
+    moment_columns = []
+    if engine == "moments":
+        moment_columns = [
+            c for f in funcs if f in MOMENT_FEATURES for c in MOMENT_FEATURES[f]
+        ]
+        funcs = [f for f in funcs if f not in MOMENT_FEATURES]
+        with timing.span("label_moments"):
+            moments = label_moments(segmentation)
+        per_cell = funcs or (channels and not batch_channels)
+        cells = list(bounding_boxes(segmentation)) if per_cell else []
+    else:
+        cells = list(ENGINES[engine](segmentation))
     data = []
+    profile = timing.ENABLED
+    func_times = dict.fromkeys(funcs, 0.0)
+    func_longest = dict.fromkeys(funcs, 0.0)
 
-    for i in tqdm(range(1, segmentation.max() + 1)):
-        img = segmentation == i
+    for i, window in tqdm(cells, disable=not progress):
+        img = segmentation[window] == i
+        offset = (window[0].start, window[1].start)
         data_dict = {"id": int(i)}
 
         for func in funcs:
-            out = func(img, original=original)
+            start = time.perf_counter() if profile else 0.0
+            out = func(img, original=original[window], offset=offset)
+            if profile:
+                seconds = time.perf_counter() - start
+                func_times[func] += seconds
+                func_longest[func] = max(func_longest[func], seconds)
             data_dict.update(out)
-        if channels:
+        if channels and not batch_channels:
             channel_dict = {}
-            for channel in CHANNEL_NUM.keys():
-                if x is None and y is None:
-                    channel_img = experiment.get_slide(name=channel)
-                else:
-                    channel_img = experiment.get_tile(x, y, name=channel)
-                channel_out = intensity(img, original=channel_img, channel=channel)
+            for channel, channel_img in channel_imgs.items():
+                channel_out = intensity(
+                    img, original=channel_img[window], channel=channel
+                )
                 channel_dict.update(channel_out)
             data_dict.update(channel_dict)
 
         data.append(data_dict)
 
-    data = pd.DataFrame(data)
+    data = pd.DataFrame(data, columns=None if data else ["id"])
+    if engine == "moments":
+        data = moments[["id"] + moment_columns].merge(data, on="id", how="left")
+    if profile:
+        for func, seconds in func_times.items():
+            name = getattr(func, "__name__", repr(func))
+            timing.add(
+                f"quantify.{name}",
+                seconds,
+                count=len(cells),
+                longest=func_longest[func],
+            )
+
+    if channels and batch_channels:
+        with timing.span("label_intensity"):
+            intensities = label_intensity(
+                segmentation, channel_imgs.values(), list(channel_imgs.keys())
+            )
+        data = data.merge(intensities, on="id", how="left")
 
     return data
@@ -7,7 +7,16 @@ from matplotlib.patches import Patch
 from skimage.io import imread
 from stardist.plot import render_label
 
-from codex.helper import CHANNEL_NUM, TMA
+from codex.helper import (
+    CHANNEL_NUM,
+    get_tma,
+    get_window,
+    intensity_range,
+    normalize_range,
+)
+from codex.spatial import CellIndex, cells_in_window
+from codex.store import QuantificationStore
+from codex.timing import span, timed
 from codex.util import load_raw_tma
 
 COLORS = [
@@ -38,7 +47,7 @@ COLORS = [
 
 def load_tma(name, path="/g/huber/projects/CITEseq/CODEX/TIFs"):
     return load_raw_tma(
-        TMA.assign(
+        get_tma().assign(
             name=lambda tma: tma.apply(
                 lambda df: f"{df['TMA']}_{df['Row']}{df['Col']}", 1
             )
@@ -54,35 +63,72 @@ def load_segmentation(name, path="/g/huber/projects/CITEseq/CODEX/stardist/masks
     )
 
 
-def load_quantification(name, path="/g/huber/projects/CITEseq/CODEX/stardist/tables"):
-    return pd.read_csv(
+def load_quantification(
+    name, path="/g/huber/projects/CITEseq/CODEX/stardist/tables", columns=None
+):
+    """
+    Loads the quantification of a core from a QuantificationStore in path, or
+    from <path>/<name>.csv. Only the given columns are returned.
+    """
+    try:
+        return QuantificationStore(path).read(name, columns=columns)
+    except KeyError:
+        pass
+
+    df = pd.read_csv(
         f"{path}/{name}.csv",
         index_col=0,
     )
+    return df if columns is None else df[columns]
 
 
-def label_segmentation_mask(segmentation, annotation, type_col="type", id_col="id"):
+def label_segmentation_mask(
+    segmentation, annotation, type_col="type", id_col="id", max_lut_size=2**26
+):
     """
     Relabels a segmentation according to the annotations df (contains the columns type, cell).
+    The types are gathered from a dense id -> type lookup table in one pass; if the
+    label ids exceed max_lut_size the lookup is done on the sorted ids in chunks.
     """
-    labeled_segmentation = segmentation.copy()
     cell_types = annotation.loc[:, type_col].values.astype(int)
     cell_ids = annotation.loc[:, id_col].values
 
     if 0 in cell_types:
         cell_types += 1
 
-    for t in np.unique(cell_types):
-        mask = np.isin(segmentation, cell_ids[cell_types == t])
-        labeled_segmentation[mask] = t
-
-    # remove cells that are not indexed
-    neg_mask = ~np.isin(segmentation, cell_ids)
-    labeled_segmentation[neg_mask] = 0
+    # drop ids that cannot occur in the segmentation (e.g. NaN after a merge)
+    max_id = segmentation.max()
+    valid = (cell_ids >= 0) & (cell_ids <= max_id)
+    if np.issubdtype(cell_ids.dtype, np.floating):
+        valid &= np.isfinite(cell_ids) & (cell_ids == np.round(cell_ids))
+    cell_ids, cell_types = cell_ids[valid].astype(np.int64), cell_types[valid]
+
+    # ids annotated more than once get the highest type
+    order = np.argsort(cell_types, kind="stable")[::-1]
+    cell_ids, first = np.unique(cell_ids[order], return_index=True)
+    cell_types = cell_types[order][first].astype(segmentation.dtype)
+
+    if max_id < max_lut_size:
+        lut = np.zeros(max_id + 1, dtype=segmentation.dtype)
+        lut[cell_ids] = cell_types
+        return lut[segmentation]
+
+    labeled_segmentation = np.zeros_like(segmentation)
+    if len(cell_ids) == 0:
+        return labeled_segmentation
+
+    rows = max(1, 2**22 // max(segmentation.shape[-1], 1))
+    for start in range(0, segmentation.shape[0], rows):
+        chunk = segmentation[start : start + rows]
+        pos = np.minimum(np.searchsorted(cell_ids, chunk), len(cell_ids) - 1)
+        labeled_segmentation[start : start + rows] = np.where(
+            cell_ids[pos] == chunk, cell_types[pos], 0
+        )
 
     return labeled_segmentation
 
 
+@timed("render_label")
 def label_cells(raw_image, labeled_segmentation, cmap, **kwargs):
     return render_label(labeled_segmentation, img=raw_image, cmap=cmap, **kwargs)
 
@@ -135,6 +181,9 @@ class CodexVis:
         self.labeled_segmentation = label_segmentation_mask(
             self.data.segmentation, self.annotation, self.type_col, self.id_col
         )
+        self.index = CellIndex(self.annotation)
+        # (low, high) intensity percentiles of every channel
+        self.intensity_ranges = {}
         self.cmap, self.legend = generate_cmap(
             self.labeled_segmentation.max() + 1, colors=colors, labels=labels
         )
@@ -155,24 +204,22 @@ class CodexVis:
         highlight=[],
         axis_off=False,
         ax=None,
+        margin=16,
     ):
+        """
+        Shows the (type) segmentation within xlim/ylim. Only this window plus a
+        margin is rendered, the returned labeled image covers the same region.
+        """
         if ax is None:
             fig = plt.figure(figsize=(24, 24))
             ax = plt.gca()
-
-        cell_ids = []
-        if cell_filter is not None:
-            sub = self.annotation[cell_filter]
-
         else:
-            sub = self.annotation
+            fig = ax.figure
 
-        sub = sub[
-            (sub.x < xlim[1])
-            & (sub.x > xlim[0])
-            & (sub.y < ylim[1])
-            & (sub.y > ylim[0])
-        ]
+        cell_ids = []
+        sub = cells_in_window(
+            self.annotation, xlim, ylim, cell_filter, index=self.index
+        )
 
         if annotate:
             for i, row in sub.iterrows():
@@ -197,20 +244,29 @@ class CodexVis:
 
                 cell_ids.append(cell_id)
 
-        if type_segmentation:
+        # only the window (plus a margin) is rendered
+        image = self.data.image[CHANNEL_NUM[name], 0 if name == "Hoechst" else 1]
+        rows, cols = get_window(image.shape, xlim, ylim, margin=margin)
+        segmentation = (
+            self.labeled_segmentation if type_segmentation else self.data.segmentation
+        )
+        # normalized like the whole channel, not just the window
+        if name not in self.intensity_ranges:
+            self.intensity_ranges[name] = intensity_range(image)
+        window = normalize_range(image[rows, cols], *self.intensity_ranges[name])
+        with span("render_label"):
             labeled = render_label(
-                self.labeled_segmentation,
-                img=self.data.image[CHANNEL_NUM[name], 0 if name == "Hoechst" else 1],
+                segmentation[rows, cols],
+                img=window,
                 cmap=self.cmap,
+                normalize_img=False,
             )
-        else:
-            labeled = render_label(
-                self.data.segmentation,
-                img=self.data.image[CHANNEL_NUM[name], 0 if name == "Hoechst" else 1],
-                cmap=self.cmap,
-            ) 
 
-        ax.imshow(labeled, origin=origin)
+        bottom, top = rows.start - 0.5, rows.stop - 0.5
+        if origin == "upper":
+            bottom, top = top, bottom
+        extent = (cols.start - 0.5, cols.stop - 0.5, bottom, top)
+        ax.imshow(labeled, origin=origin, extent=extent)
         ax.set_xlim(xlim)
         ax.set_ylim(ylim)
         ax.legend(handles=self.legend, fontsize=16, framealpha=1)
@@ -0,0 +1,120 @@
+from typing import Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+class CellIndex:
+    """
+    Spatial index over the cell centroids (x and y columns) of a quantification.
+    Bounding box queries use a grid of square buckets, radius and nearest
+    neighbour queries a KD-tree that is built on first use. Queries return
+    positions (for df.iloc) in the order of the DataFrame.
+    """
+
+    def __init__(self, df: pd.DataFrame, bucket_size: float = 64, x="x", y="y"):
+        self.df = df
+        points = df[[x, y]].to_numpy(dtype=float)
+        self.positions = np.flatnonzero(np.isfinite(points).all(axis=1))
+        self.points = points[self.positions]
+        self.bucket_size = bucket_size
+
+        if len(self.points):
+            self.origin = self.points.min(axis=0)
+            cells = self._bucket(self.points)
+            self.shape = tuple(cells.max(axis=0) + 1)
+        else:
+            self.origin = np.zeros(2)
+            cells = np.zeros((0, 2), dtype=int)
+            self.shape = (1, 1)
+
+        # cells sorted by bucket (row-major over x), starts[b] is the first of b
+        buckets = cells[:, 1] * self.shape[0] + cells[:, 0]
+        self.order = np.argsort(buckets, kind="stable")
+        self.starts = np.searchsorted(
+            buckets[self.order], np.arange(self.shape[0] * self.shape[1] + 1)
+        )
+        self._tree = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def _bucket(self, points: np.ndarray) -> np.ndarray:
+        cells = np.floor((points - self.origin) / self.bucket_size)
+        return np.clip(cells, -1, np.iinfo(np.int32).max).astype(int)
+
+    @property
+    def tree(self) -> cKDTree:
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+    def box(self, xlim, ylim) -> np.ndarray:
+        """
+        Returns the cells with xlim[0] < x < xlim[1] and ylim[0] < y < ylim[1].
+        """
+        lower = self._bucket(np.array([xlim[0], ylim[0]], dtype=float))
+        upper = self._bucket(np.array([xlim[1], ylim[1]], dtype=float))
+        x0, y0 = np.maximum(lower, 0)
+        x1, y1 = np.minimum(upper, np.array(self.shape) - 1)
+        if x0 > x1 or y0 > y1:
+            return np.zeros(0, dtype=int)
+
+        # the buckets x0..x1 of a grid row are contiguous
+        rows = [y * self.shape[0] for y in range(y0, y1 + 1)]
+        candidates = np.concatenate(
+            [self.order[self.starts[r + x0] : self.starts[r + x1 + 1]] for r in rows]
+        )
+        points = self.points[candidates]
+        inside = (
+            (points[:, 0] > xlim[0])
+            & (points[:, 0] < xlim[1])
+            & (points[:, 1] > ylim[0])
+            & (points[:, 1] < ylim[1])
+        )
+        return self.positions[np.sort(candidates[inside])]
+
+    def radius(self, x: float, y: float, r: float) -> np.ndarray:
+        """
+        Returns the cells within distance r of (x, y).
+        """
+        return self.positions[np.sort(self.tree.query_ball_point((x, y), r))]
+
+    def nearest(self, x: float, y: float, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the distances to and positions of the k cells closest to (x, y).
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros(0), np.zeros(0, dtype=int)
+        distances, cells = self.tree.query((x, y), k=[i + 1 for i in range(k)])
+        return distances, self.positions[cells]
+
+
+def cells_in_window(
+    df: pd.DataFrame,
+    xlim,
+    ylim,
+    cell_filter=None,
+    index: Union[None, CellIndex] = None,
+) -> pd.DataFrame:
+    """
+    Returns the rows of df (passing cell_filter) with centroids strictly inside
+    xlim/ylim. With an index built from df only the cells near the window are
+    tested.
+    """
+    if index is None:
+        sub = df if cell_filter is None else df[cell_filter]
+        return sub[
+            (sub.x < xlim[1])
+            & (sub.x > xlim[0])
+            & (sub.y < ylim[1])
+            & (sub.y > ylim[0])
+        ]
+
+    positions = index.box(xlim, ylim)
+    if cell_filter is not None:
+        positions = positions[np.asarray(cell_filter)[positions]]
+
+    return df.iloc[positions]
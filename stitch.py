@@ -0,0 +1,50 @@
+from typing import Tuple
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def edge_pairs(slide: np.ndarray, x_ticks, y_ticks, min_overlap: int = 1) -> np.ndarray:
+    """
+    Returns the (n, 2) label pairs that face each other across the inner tile
+    edges of a restored slide along at least min_overlap pixels.
+    """
+    sides = [(slide[:, t - 1], slide[:, t]) for t in x_ticks[1:-1]]
+    sides += [(slide[t - 1], slide[t]) for t in y_ticks[1:-1]]
+    if not sides:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    a = np.concatenate([s[0] for s in sides]).astype(np.int64)
+    b = np.concatenate([s[1] for s in sides]).astype(np.int64)
+    touching = (a > 0) & (b > 0) & (a != b)
+    a, b = a[touching], b[touching]
+
+    pairs, counts = np.unique(np.stack([a, b], axis=1), axis=0, return_counts=True)
+    return pairs[counts >= min_overlap]
+
+
+def stitch_labels(
+    slide: np.ndarray, x_ticks, y_ticks, min_overlap: int = 1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merges labels that were cut by tile edges. Touching labels are grouped by
+    connected components over the label pairs and each group gets the smallest
+    id of its members in a single lookup table pass, so cells that were not
+    cut keep their ids. Returns the stitched slide and the ids of the merged
+    cells.
+    """
+    pairs = edge_pairs(slide, x_ticks, y_ticks, min_overlap=min_overlap)
+    if len(pairs) == 0:
+        return slide, np.zeros(0, dtype=slide.dtype)
+
+    n = int(slide.max()) + 1
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), (n, n))
+    _, components = connected_components(graph, directed=False)
+
+    # the smallest label of every component
+    roots = np.full(components.max() + 1, n, dtype=np.int64)
+    np.minimum.at(roots, components, np.arange(n))
+    lut = roots[components].astype(slide.dtype)
+
+    return lut[slide], np.unique(lut[pairs[:, 0]])
@@ -0,0 +1,97 @@
+import os
+from typing import List, Union
+
+import pandas as pd
+
+EXTENSION = ".parquet"
+
+
+class QuantificationStore:
+    """
+    Folder of quantification results in parquet format, one file per unit:
+    <path>/<core>.parquet for whole cores and <path>/<core>/<x>_<y>.parquet
+    for single tiles. Files are written atomically, so a unit is either
+    complete or missing and interrupted runs can skip the finished units.
+
+    Ids and coordinates of tile level results are those of the tile (ids are
+    numbered per tile), reading them adds the tile_x and tile_y of every row.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.normpath(path)
+
+    def _file(self, key) -> str:
+        if isinstance(key, tuple):
+            name, x, y = key
+            return os.path.join(self.path, name, f"{x}_{y}{EXTENSION}")
+        return os.path.join(self.path, key + EXTENSION)
+
+    def __contains__(self, key) -> bool:
+        return os.path.exists(self._file(key))
+
+    def _tiles(self, name: str) -> List[str]:
+        folder = os.path.join(self.path, name)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(
+            os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(EXTENSION)
+        )
+
+    def names(self) -> List[str]:
+        """
+        Returns the cores with (core or tile level) results.
+        """
+        if not os.path.isdir(self.path):
+            return []
+
+        names = set()
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith(EXTENSION):
+                names.add(entry.name[: -len(EXTENSION)])
+            elif entry.is_dir() and self._tiles(entry.name):
+                names.add(entry.name)
+        return sorted(names)
+
+    def write(self, key, df: pd.DataFrame):
+        """
+        Stores the results of a core (key=name) or tile (key=(name, x, y)).
+        """
+        target = self._file(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{os.getpid()}.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, target)
+
+    def read(
+        self,
+        names: Union[None, str, List[str]] = None,
+        columns: Union[None, List[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Reads the results of one core, a list of cores or (names=None) all
+        cores. Only the given columns are loaded from disk. Results of several
+        cores get an additional core column.
+        """
+        if isinstance(names, str):
+            return self._read_core(names, columns)
+
+        names = self.names() if names is None else names
+        return pd.concat(
+            [self._read_core(name, columns).assign(core=name) for name in names],
+            ignore_index=True,
+        )
+
+    def _read_core(self, name: str, columns: Union[None, List[str]]) -> pd.DataFrame:
+        files = [self._file(name)] if name in self else self._tiles(name)
+        if not files:
+            raise KeyError(name)
+
+        if name in self:
+            return pd.read_parquet(files[0], columns=columns)
+
+        tiles = []
+        for f in files:
+            x, y = os.path.basename(f)[: -len(EXTENSION)].split("_")
+            df = pd.read_parquet(f, columns=columns)
+            tiles.append(df.assign(tile_x=int(x), tile_y=int(y)))
+        return pd.concat(tiles, ignore_index=True)
@@ -0,0 +1,123 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Union
+
+# timing is off unless enabled here or through the environment
+ENABLED = os.environ.get("CODEX_TIMING", "") not in ("", "0")
+
+_LOCK = threading.Lock()
+_EVENTS = []
+_STATS = {}
+
+
+def enable(on: bool = True):
+    global ENABLED
+    ENABLED = on
+
+
+def disable():
+    enable(False)
+
+
+def reset():
+    with _LOCK:
+        _EVENTS.clear()
+        _STATS.clear()
+
+
+def add(name: str, seconds: float, count: int = 1, longest: float = None):
+    """
+    Adds the time of count calls to the statistics of name without recording a
+    trace event, for stages that run too often to trace every call (e.g. per
+    cell). longest is the longest of the calls (seconds for a single call).
+    """
+    if longest is None:
+        longest = seconds if count == 1 else 0.0
+    with _LOCK:
+        stats = _STATS.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        stats["count"] += count
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], longest)
+
+
+@contextmanager
+def span(name: str, **args):
+    """
+    Times the enclosed block as a named span (a no-op unless enabled).
+    """
+    if not ENABLED:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        add(name, duration)
+        with _LOCK:
+            _EVENTS.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {k: str(v) for k, v in args.items()},
+                }
+            )
+
+
+def timed(name: Union[None, str] = None) -> Callable:
+    """
+    Decorator that runs a function inside a span (named after the function).
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with span(name or func.__qualname__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def summary() -> dict:
+    """
+    Returns count, total, mean and max seconds of every span.
+    """
+    with _LOCK:
+        return {
+            name: dict(stats, mean=stats["total"] / max(stats["count"], 1))
+            for name, stats in sorted(_STATS.items())
+        }
+
+
+def to_json(path: str):
+    """
+    Writes the summary and all recorded spans to path.
+    """
+    with _LOCK:
+        events = list(_EVENTS)
+    with open(path, "w") as f:
+        json.dump({"summary": summary(), "spans": events}, f, indent=2)
+
+
+def to_chrome_trace(path: str):
+    """
+    Writes the recorded spans in Chrome trace format (chrome://tracing or
+    https://ui.perfetto.dev).
+    """
+    with _LOCK:
+        events = list(_EVENTS)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
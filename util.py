@@ -1,59 +1,62 @@
 import os
 
-import cv2
-from skimage.io import imread
+import numpy as np
 
 from codex.experiment import Codex
-from codex.helper import IMG_FULL, crop_tma
+from codex.helper import IMG_FULL, core_name, crop_tma, read_tma
+from codex.index import scan_cohort
+from codex.preprocess import CLAHE
+from codex.timing import timed
 
+# the CLAHE object is configured once (per thread) and reused
+_CLAHE = CLAHE(clip_limit=2, tile_grid_size=(12, 12))
 
-def clahe(img):
-    # print('Applying clahe')
-    clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(12, 12))
-    return clahe.apply(img)
-
-
-def load_all_tma(tma, tma_path, offset=None):
-    current_tma = ""
-    codex_slides = {}
-
-    for i, row in tma.iterrows():
-        # print(f"{row['TMA']}_{row['Row']}{row['Col']}")
-        if row["TMA"] != current_tma:
-            # print(f"Loading {cd.IMG_FULL[row['TMA']]}.")
-            img = imread(IMG_FULL[row["TMA"]])
-            current_tma = row["TMA"]
-
-        codex_slides[f"{row['TMA']}_{row['Row']}{row['Col']}"] = crop_tma(
-            img, row["Row"], row["Col"], nrows=row["Nrows"], ncols=row["Ncols"]
-        )
-
-    segmentation = {}
-
-    for i, row in tma.iterrows():
-        # print(f"{row['TMA']}_{row['Row']}{row['Col']}")
-        seg_path = os.path.join(tma_path, f"{row['TMA']}_{row['Row']}{row['Col']}_128")
-        segmentation[f"{row['TMA']}_{row['Row']}{row['Col']}"] = Codex(
-            seg_path,
-            codex_slides[f"{row['TMA']}_{row['Row']}{row['Col']}"],
-            offset=offset,
-        )
 
+def clahe(img):
+    return _CLAHE(img)
+
+
+def iter_cores(tma, lazy=True):
+    """
+    Yields (name, image) for every core of the TMA table. The rows are grouped
+    by TMA file and every file is read once; it is released before the next
+    one is read. With lazy=False the cores are copied out of the decoded TMA.
+    """
+    for tma_name, rows in tma.groupby("TMA", sort=False):
+        img = read_tma(IMG_FULL[tma_name], lazy=lazy)
+        for row in rows.to_dict("records"):
+            core = crop_tma(
+                img, row["Row"], row["Col"], nrows=row["Nrows"], ncols=row["Ncols"]
+            )
+            yield core_name(row), core if lazy else np.array(core)
+        del img
+
+
+def iter_tma(tma, tma_path, offset=None, lazy=True, persist=True):
+    """
+    Yields (name, Codex) core by core, so at most one TMA image has to be held
+    in memory (besides the cores kept by the caller). With persist the cores
+    store their restored slides and pyramids on disk (see Codex).
+    """
+    # index the tile folders of all requested cores at once
+    folders = [f"{core_name(row)}_128" for row in tma.to_dict("records")]
+    indices = scan_cohort(tma_path, folders=folders)
+
+    for name, img in iter_cores(tma, lazy=lazy):
+        seg_path = os.path.normpath(os.path.join(tma_path, f"{name}_128"))
+        index = indices.get(seg_path)
+        yield name, Codex(seg_path, img, offset=offset, index=index, persist=persist)
+
+
+@timed("load_all_tma")
+def load_all_tma(tma, tma_path, offset=None, lazy=True, persist=True):
+    segmentation = dict(
+        iter_tma(tma, tma_path, offset=offset, lazy=lazy, persist=persist)
+    )
+    codex_slides = {name: experiment.img for name, experiment in segmentation.items()}
     return codex_slides, segmentation
 
 
-def load_raw_tma(tma, tma_path):
-    current_tma = ""
-    codex_slides = {}
-
-    for i, row in tma.iterrows():
-        # print(f"{row['TMA']}_{row['Row']}{row['Col']}")
-        if row["TMA"] != current_tma:
-            # print(f"Loading {cd.IMG_FULL[row['TMA']]}.")
-            img = imread(IMG_FULL[row["TMA"]])
-            current_tma = row["TMA"]
-
-        codex_slides[f"{row['TMA']}_{row['Row']}{row['Col']}"] = crop_tma(
-            img, row["Row"], row["Col"], nrows=row["Nrows"], ncols=row["Ncols"]
-        )
-    return codex_slides
+@timed("load_raw_tma")
+def load_raw_tma(tma, tma_path, lazy=True):
+    return dict(iter_cores(tma, lazy=lazy))